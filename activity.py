@@ -0,0 +1,128 @@
+import asyncio
+import logging
+
+import metrics
+import status
+
+ACTIVE = "active"
+PAUSED = "paused"
+IDLE = "idle"
+MODES = (ACTIVE, PAUSED, IDLE)
+
+
+class ActivityPolicy(object):
+    # Adapts the work done per sample to the belt activity. While the belt runs every sample
+    # is passed on to the sample callbacks, while it is paused or stopped at most one every
+    # `paused_interval` seconds. Once it hasn't been running for `idle_after` seconds the
+    # Treadmill Data notifications are unsubscribed, which stops the radio traffic and the
+    # wakeups at the pad's notification rate. That is only done once the pad actually sent a
+    # Fitness Machine Status notification on this connection, having the characteristic
+    # isn't enough. A start is then still noticed right away and the data is subscribed
+    # again. With idle_after=None the subscription is always kept.
+    #
+    # on_connect is meant as a connect callback of the ConnectionSupervisor, it subscribes to
+    # the treadmill data. Callbacks are called with (old mode, new mode).
+
+    def __init__(self, controller, paused_interval=5.0, idle_after=60.0, logger=None):
+        self.controller = controller
+        self.paused_interval = paused_interval
+        self.idle_after = idle_after
+        self.logger = logging.getLogger("walkingpad.activity") if logger is None else logger
+        self.mode = ACTIVE if controller.machine_state.is_running else PAUSED
+        self.callbacks = []
+        self.sample_callbacks = []
+        self.last_forwarded = None
+        self.unsubscribed = False
+        self.idle_timer = None
+        controller.add_sample_callback(self.on_sample)
+        controller.machine_state.add_callback(self.on_state_change)
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def add_sample_callback(self, callback):
+        self.sample_callbacks.append(callback)
+
+    def remove_sample_callback(self, callback):
+        self.sample_callbacks.remove(callback)
+
+    def set_mode(self, mode):
+        if mode == self.mode:
+            return
+        old, self.mode = self.mode, mode
+        # The first sample in the new mode is always passed on, e.g. the belt stopping
+        self.last_forwarded = None
+        self.logger.info("Activity mode " + mode)
+        for callback in self.callbacks:
+            callback(old, mode)
+
+    def on_sample(self, sample):
+        if self.mode != ACTIVE and self.last_forwarded is not None:
+            if sample.timestamp - self.last_forwarded < self.paused_interval:
+                metrics.THROTTLED_SAMPLES.inc()
+                return
+        self.last_forwarded = sample.timestamp
+        for callback in self.sample_callbacks:
+            callback(sample)
+
+    def on_state_change(self, old, new):
+        if new == status.RUNNING:
+            self.cancel_idle_timer()
+            self.set_mode(ACTIVE)
+            if self.unsubscribed:
+                asyncio.get_running_loop().create_task(self.subscribe())
+        elif self.mode != IDLE:
+            self.set_mode(PAUSED)
+            self.start_idle_timer()
+
+    async def on_connect(self):
+        self.unsubscribed = False
+        self.last_forwarded = None
+        await self.controller.treadmill_data_client.start()
+        # The state of a pad which was idle before the connection doesn't change on connect
+        if self.controller.machine_state.is_running:
+            self.set_mode(ACTIVE)
+        else:
+            self.set_mode(PAUSED)
+            self.start_idle_timer()
+
+    def start_idle_timer(self):
+        self.cancel_idle_timer()
+        if self.idle_after is not None:
+            self.idle_timer = asyncio.get_running_loop().call_later(self.idle_after, self.go_idle)
+
+    def cancel_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def go_idle(self):
+        self.idle_timer = None
+        if self.controller.machine_state.is_running or not self.controller.is_connected():
+            return
+        self.set_mode(IDLE)
+        if not self.controller.machine_state.has_status:
+            self.logger.debug("The treadmill sent no status notifications, keeping the data subscription")
+            return
+        asyncio.get_running_loop().create_task(self.unsubscribe())
+
+    async def unsubscribe(self):
+        # Paused, not stopped, stream() consumers keep waiting for samples
+        self.unsubscribed = True
+        try:
+            await self.controller.treadmill_data_client.pause()
+        except Exception as e:
+            self.logger.info("Failed to unsubscribe from treadmill data: " + str(e))
+
+    async def subscribe(self):
+        self.unsubscribed = False
+        self.last_forwarded = None
+        if not self.controller.is_connected():
+            return
+        try:
+            await self.controller.treadmill_data_client.start()
+        except Exception as e:
+            self.logger.info("Failed to subscribe to treadmill data: " + str(e))
+
+    def close(self):
+        self.cancel_idle_timer()
@@ -0,0 +1,287 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import ftms
+
+# Offline benchmarks for the hot paths: packet decoding, the notify -> parse -> store path
+# of TreadmillDataClient and status text rendering, and the cold import time of the entry
+# points. Results are written as JSON so runs of different versions can be compared with
+# --compare.
+
+RESULT_FORMAT_VERSION = 1
+
+
+def synthetic_packets(count, seed=0):
+    # Packets for every flag combination which changes the layout, with random field values
+    rng = random.Random(seed)
+    combinations = [(flags_byte1, flags_byte2)
+                    for flags_byte1 in range(0, 0x100, 2)
+                    for flags_byte2 in range(0x20)]
+    packets = []
+    for i in range(count):
+        layout = ftms.get_treadmill_data_layout(*combinations[i % len(combinations)])
+        packets.append(bytearray(layout.flags) + bytearray(rng.getrandbits(8) for _ in range(layout.size - 2)))
+    return packets
+
+
+def walking_pad_packets(count):
+    # What a real pad sends: speed, distance, energy and elapsed time
+    return [bytearray(ftms.build_treadmill_data({
+        'instantaneous_speed': 300 + i % 100,
+        'total_distance': i,
+        'expended_energy': i // 20,
+        'energy_per_hour': 0,
+        'energy_per_minute': 0,
+        'elapsed_time': i & 0xFFFF,
+    }, 0x84, 0x04)) for i in range(count)]
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(func, items):
+    count = len(items)
+
+    # Throughput
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    elapsed = time.perf_counter() - start
+
+    # Per call latency
+    perf_counter_ns = time.perf_counter_ns
+    latencies = []
+    for item in items:
+        call_start = perf_counter_ns()
+        func(item)
+        latencies.append(perf_counter_ns() - call_start)
+    latencies.sort()
+
+    # Allocations, the results are kept alive so every allocation of a call is counted
+    results = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for item in items:
+        results.append(func(item))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    del results
+
+    return {
+        'packets': count,
+        'packets_per_second': count / elapsed if elapsed else None,
+        'latency_us': {
+            'p50': percentile(latencies, 0.50) / 1000,
+            'p90': percentile(latencies, 0.90) / 1000,
+            'p99': percentile(latencies, 0.99) / 1000,
+            'max': latencies[-1] / 1000,
+        },
+        # The results list itself adds one pointer per packet, it is not subtracted
+        'allocated_blocks_per_packet': blocks / count,
+        'allocated_bytes_per_packet': size / count,
+    }
+
+
+def bench_parser(count):
+    packets = synthetic_packets(count)
+    return {
+        'parse_treadmill_data': measure(ftms.parse_treadmill_data, packets),
+        'parse_treadmill_sample': measure(ftms.parse_treadmill_sample, packets),
+    }
+
+
+class NullClient(object):
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        pass
+
+    async def stop_notify(self, char_specifier):
+        pass
+
+
+def bench_pipeline(count):
+    import controller
+
+    data_client = controller.TreadmillDataClient(NullClient(), None)
+    packets = walking_pad_packets(count)
+
+    def notify(packet):
+        data_client.treadmill_data_handler(None, packet)
+
+    return {'treadmill_data_handler': measure(notify, packets)}
+
+
+def bench_render(count):
+    import stats
+    import status
+    import treadmill
+
+    # The status bar module without init(), which would start the event loop and connect
+    module = treadmill.Treadmill.__new__(treadmill.Treadmill)
+    module.stats = stats.SessionStats()
+    module.machine_state = status.MachineState()
+    module.output = {}
+    module.compile_format()
+    samples = [ftms.parse_treadmill_sample(packet) for packet in walking_pad_packets(count)]
+    return {
+        'render_sample': measure(module.render_sample, samples),
+        # Samples whose referenced fields didn't change skip rendering
+        'render_sample_unchanged': measure(module.render_sample, [samples[0]] * count),
+    }
+
+
+BENCHMARKS = (
+    ('parser', bench_parser),
+    ('pipeline', bench_pipeline),
+    ('render', bench_render),
+)
+
+# Modules timed by the import benchmark and the dependencies each of them must not load
+IMPORT_TARGETS = (
+    ('ftms', ('asyncio', 'bleak', 'i3pystatus')),
+    ('controller', ('bleak', 'i3pystatus')),
+    ('daemon', ('bleak', 'i3pystatus', 'sqlite3', 'http.server')),
+    ('treadmill', ('bleak', 'sqlite3', 'http.server')),
+    ('cli', ('bleak', 'i3pystatus', 'sqlite3', 'http.server')),
+)
+
+
+def measure_import(module, forbidden, runs):
+    # Every run imports the module in a fresh interpreter, the time is taken from -X importtime
+    code = "import sys, %s; sys.stdout.write(' '.join(sys.modules))" % module
+    times = []
+    loaded = set()
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            raise ImportError(result.stderr.strip().splitlines()[-1])
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                times.append(int(fields[1]) / 1000)
+        loaded = set(result.stdout.split())
+    times.sort()
+    return {
+        'import_ms': {'min': times[0], 'p50': percentile(times, 0.50), 'max': times[-1]},
+        'runs': runs,
+        'modules': len(loaded),
+        'unexpected_imports': [name for name in forbidden if name in loaded],
+    }
+
+
+def bench_imports(runs=5):
+    results = {}
+    skipped = {}
+    for module, forbidden in IMPORT_TARGETS:
+        try:
+            results[module] = measure_import(module, forbidden, runs)
+        except ImportError as e:
+            skipped[module] = str(e)
+    return results, skipped
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(count=20000, names=None):
+    report = {
+        'format_version': RESULT_FORMAT_VERSION,
+        'timestamp': time.time(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'results': {},
+        'imports': {},
+        'skipped': {},
+    }
+    for name, benchmark in BENCHMARKS:
+        if names and name not in names:
+            continue
+        try:
+            report['results'].update(benchmark(count))
+        except ImportError as e:
+            # The pipeline and render benchmarks need the BLE and status bar dependencies
+            report['skipped'][name] = str(e)
+    if not names or 'imports' in names:
+        report['imports'], skipped = bench_imports()
+        report['skipped'].update(("import " + module, error) for module, error in skipped.items())
+    return report
+
+
+def compare(report, baseline):
+    lines = []
+    for name, result in sorted(report['results'].items()):
+        old = baseline.get('results', {}).get(name)
+        if old is None or not old.get('packets_per_second'):
+            lines.append("%-24s %12.0f pkt/s" % (name, result['packets_per_second']))
+            continue
+        ratio = result['packets_per_second'] / old['packets_per_second']
+        lines.append("%-24s %12.0f pkt/s  %+6.1f%% vs %s" % (
+            name, result['packets_per_second'], (ratio - 1) * 100, baseline.get('revision')))
+    for module, result in sorted(report.get('imports', {}).items()):
+        old = baseline.get('imports', {}).get(module)
+        line = "import %-17s %12.1f ms" % (module, result['import_ms']['p50'])
+        if old is not None:
+            line += "  %+6.1f ms vs %s" % (result['import_ms']['p50'] - old['import_ms']['p50'], baseline.get('revision'))
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def add_arguments(parser):
+    parser.add_argument('--packets', type=int, default=20000, help="packets per benchmark")
+    parser.add_argument('--only', action='append', choices=[name for name, _ in BENCHMARKS] + ['imports'],
+                        help="run only the given benchmark, can be repeated")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    parser.add_argument('--compare', help="JSON report of a previous run to compare against")
+
+
+def run(args):
+    # Returns the exit status
+    report = run_benchmarks(args.packets, args.only)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        sys.stderr.write(compare(report, baseline) + "\n")
+    unexpected = ["%s imports %s" % (module, ", ".join(result['unexpected_imports']))
+                  for module, result in sorted(report['imports'].items()) if result['unexpected_imports']]
+    if unexpected:
+        sys.stderr.write("Lazy imports broken: " + "; ".join(unexpected) + "\n")
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the treadmill data hot paths")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+import ftms
+import recorder
+import stats
+import supervisor
+from controller import TreadmillController
+
+# Command line entry point, every subcommand runs on one event loop:
+#
+#   python cli.py monitor [--address ADDRESS] [--count N]   decoded samples as JSON lines
+#   python cli.py record PATH [--duration SECONDS]          raw notifications to a session file
+#   python cli.py replay PATH [--speed 1.0]                 a session file as JSON lines
+#   python cli.py bench [--packets N] [--only parser]       parser and pipeline throughput
+#
+# Sample lines are {"time": <wall clock>, "instantaneous_speed": 300, ...} with the fields the
+# pad sent, logs go to stderr.
+
+
+def encode_sample(sample, wall_time):
+    data = sample.as_dict()
+    data["time"] = round(wall_time, 3)
+    return json.dumps(data, separators=(',', ':')) + "\n"
+
+
+class JsonLinesOutput(object):
+    # Bounded buffer between the sample callbacks and a blocking stream. One task writes
+    # everything queued in a single write from a worker thread, so a slow reader never
+    # blocks the event loop. Live samples are added with add(), which drops the oldest
+    # line if the buffer is full, replays await put(), which waits for free space. Putting
+    # None ends the output.
+
+    def __init__(self, stream, buffer_size=256, limit=None):
+        self.stream = stream
+        self.queue = asyncio.Queue(buffer_size)
+        self.limit = limit
+        self.written = 0
+        self.dropped = 0
+        self.closed = False
+
+    def add(self, line):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(line)
+
+    async def put(self, line):
+        # Lines are discarded once the reader went away
+        if not self.closed:
+            await self.queue.put(line)
+
+    def write(self, data):
+        try:
+            self.stream.write(data)
+            self.stream.flush()
+        except BrokenPipeError:
+            # The reader went away, e.g. piped into head
+            self.closed = True
+            os.dup2(os.open(os.devnull, os.O_WRONLY), self.stream.fileno())
+
+    async def run(self):
+        # Returns at the end of the output, once `limit` lines are written or when the
+        # stream is closed
+        loop = asyncio.get_running_loop()
+        while not self.closed and (self.limit is None or self.written < self.limit):
+            lines = [await self.queue.get()]
+            while not self.queue.empty():
+                lines.append(self.queue.get_nowait())
+            finished = None in lines
+            if finished:
+                lines = lines[:lines.index(None)]
+            if self.limit is not None:
+                lines = lines[:self.limit - self.written]
+            if lines:
+                await loop.run_in_executor(None, self.write, "".join(lines))
+                self.written += len(lines)
+            if finished:
+                return
+
+
+async def start_streaming(controller):
+    await controller.treadmill_data_client.start()
+
+
+def connect(controller, logger):
+    connection = supervisor.ConnectionSupervisor(controller, logger.getChild("supervisor"))
+    connection.connect_callbacks.append(lambda: start_streaming(controller))
+    connection.start()
+    return connection
+
+
+async def monitor(args, logger):
+    controller = TreadmillController(logger.getChild("controller"), address=args.address)
+    output = JsonLinesOutput(sys.stdout, args.buffer, args.count)
+    # Sample timestamps are monotonic, which stops during suspend, the output has the wall
+    # clock time the sample arrived at
+    controller.add_sample_callback(lambda sample: output.add(encode_sample(sample, time.time())))
+    connection = connect(controller, logger)
+    try:
+        await output.run()
+    finally:
+        await connection.close()
+        if output.dropped:
+            logger.warning("Dropped %d samples, the output didn't keep up" % output.dropped)
+
+
+async def record(args, logger):
+    session = recorder.SessionRecorder(args.path)
+    controller = TreadmillController(logger.getChild("controller"), recorder=session, address=args.address)
+    connection = connect(controller, logger)
+    try:
+        if args.duration:
+            await asyncio.sleep(args.duration)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await connection.close()
+        session.close()
+        logger.info("Recorded %d samples to %s" % (controller.stats.samples, args.path))
+
+
+async def replay(args, logger):
+    output = JsonLinesOutput(sys.stdout, args.buffer)
+    writer = asyncio.get_running_loop().create_task(output.run())
+    session_stats = stats.SessionStats()
+    invalid = 0
+    loop = asyncio.get_running_loop()
+    with recorder.SessionReader(args.path) as reader:
+        start = None
+        for timestamp, packet in reader:
+            if args.speed > 0:
+                # Absolute deadlines keep the original pacing without drift
+                if start is None:
+                    start = (loop.time(), timestamp)
+                delay = start[0] + (timestamp - start[1]) / args.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                sample = ftms.parse_treadmill_sample(packet, timestamp)
+            except (ValueError, struct.error):
+                invalid += 1
+                continue
+            session_stats.update(sample)
+            await output.put(encode_sample(sample, timestamp))
+            if output.closed:
+                break
+    await output.put(None)
+    await writer
+    summary = session_stats.as_dict()
+    summary["invalid_packets"] = invalid
+    sys.stderr.write(json.dumps(summary) + "\n")
+
+
+def bench(args, logger):
+    import bench as benchmarks
+    parser = argparse.ArgumentParser(prog="cli.py bench", description="Parser and pipeline throughput")
+    benchmarks.add_arguments(parser)
+    bench_args = parser.parse_args(args.bench_args)
+    if not bench_args.only:
+        bench_args.only = ['parser', 'pipeline']
+    return benchmarks.run(bench_args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Walking pad command line")
+    parser.add_argument('--log-level', default="WARNING")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    monitor_parser = subparsers.add_parser("monitor", help="print decoded samples as JSON lines")
+    monitor_parser.add_argument('--address', default=None, help="bluetooth address of the walking pad")
+    monitor_parser.add_argument('--count', type=int, default=None, help="exit after this many samples")
+    monitor_parser.add_argument('--buffer', type=int, default=256,
+                                help="samples kept while the output is behind, older ones are dropped")
+    monitor_parser.set_defaults(run=monitor)
+
+    record_parser = subparsers.add_parser("record", help="append raw notifications to a session file")
+    record_parser.add_argument('path')
+    record_parser.add_argument('--address', default=None, help="bluetooth address of the walking pad")
+    record_parser.add_argument('--duration', type=float, default=None, help="stop after this many seconds")
+    record_parser.set_defaults(run=record)
+
+    replay_parser = subparsers.add_parser("replay", help="print a session file as JSON lines")
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--speed', type=float, default=0,
+                               help="replay speed relative to the recording, 0 for as fast as possible")
+    replay_parser.add_argument('--buffer', type=int, default=256)
+    replay_parser.set_defaults(run=replay)
+
+    # The options are parsed by bench.py, which is only imported when it runs
+    bench_parser = subparsers.add_parser("bench", help="parser and pipeline throughput", add_help=False)
+    bench_parser.set_defaults(run=bench)
+
+    args, args.bench_args = parser.parse_known_args(argv)
+    if args.bench_args and args.command != "bench":
+        parser.error("unrecognized arguments: " + " ".join(args.bench_args))
+    logging.basicConfig(stream=sys.stderr, level=args.log_level,
+                        format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    logger = logging.getLogger("walkingpad")
+    try:
+        if asyncio.iscoroutinefunction(args.run):
+            status = asyncio.run(args.run(args, logger))
+        else:
+            status = args.run(args, logger)
+    except KeyboardInterrupt:
+        status = 0
+    sys.exit(status or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,488 @@
+import asyncio
+import struct
+import time
+
+import devicecache
+import ftms
+import history
+import metrics
+import scheduler
+import stats
+import status
+
+# BLE transport for one walking pad: the Treadmill Data subscription, the Fitness Machine
+# Control Point and the controller tying them to a bleak client. The codec is in ftms, bleak
+# is only imported once a connection is made.
+
+
+class TreadmillDataClient(object):
+    def __init__(self, client, treadmill_data_characteristic, first_sample_timeout=2, sample_history=None):
+        self.treadmill_data_characteristic = treadmill_data_characteristic
+        self.client = client
+        self.first_sample_timeout = first_sample_timeout
+        self.sample = None
+        self.history = history.SampleHistory() if sample_history is None else sample_history
+        self.is_streaming = False
+        self.callbacks = []
+        self.raw_callbacks = []
+        self.queues = []
+        self.sample_event = asyncio.Event()
+        # Flags and layout of the previous packet, a pad keeps sending the same fields
+        self.flags = None
+        self.layout = None
+
+    async def start(self):
+        # Subscribe once and keep the subscription open for the lifetime of the connection
+        if self.is_streaming:
+            return
+        await self.client.start_notify(self.treadmill_data_characteristic, self.treadmill_data_handler)
+        self.is_streaming = True
+
+    async def pause(self):
+        # Unsubscribes without ending the streams, they continue after the next start()
+        if not self.is_streaming:
+            return
+        self.is_streaming = False
+        await self.client.stop_notify(self.treadmill_data_characteristic)
+
+    async def stop(self):
+        try:
+            await self.pause()
+        finally:
+            # Wake up all stream consumers so they can finish, a consumer which fell behind
+            # loses its oldest sample like in treadmill_data_handler
+            for queue in self.queues:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def read(self):
+        await self.start()
+        if self.sample is None:
+            # Wait for the first notification after subscribing
+            try:
+                await asyncio.wait_for(self.sample_event.wait(), self.first_sample_timeout)
+            except asyncio.TimeoutError:
+                pass
+        else:
+            # Let notifications that are already pending on the event loop be handled
+            await asyncio.sleep(0)
+        return self.data
+
+    @property
+    def data(self):
+        if self.sample is None:
+            return {}
+        return self.sample.as_dict()
+
+    async def stream(self, maxsize=0):
+        # Yields every decoded sample. With a bounded queue the oldest packets are dropped
+        # if the consumer can't keep up.
+        queue = asyncio.Queue(maxsize)
+        self.queues.append(queue)
+        try:
+            await self.start()
+            while True:
+                data = await queue.get()
+                if data is None:
+                    return
+                yield data
+        finally:
+            self.queues.remove(queue)
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def add_raw_callback(self, callback):
+        # Raw callbacks get the undecoded notification, e.g. for recording
+        self.raw_callbacks.append(callback)
+
+    def remove_raw_callback(self, callback):
+        self.raw_callbacks.remove(callback)
+
+    def treadmill_data_handler(self, sender, data):
+        metrics.NOTIFICATIONS.inc()
+        for callback in self.raw_callbacks:
+            callback(sender, data)
+        start = time.perf_counter()
+        try:
+            sample = self.parse_treadmill_sample(data)
+        except (ValueError, struct.error):
+            # Dropped, the previous sample stays current
+            metrics.INVALID_PACKETS.inc()
+            return
+        metrics.PARSE_TIME.observe(time.perf_counter() - start)
+        self.sample = sample
+        self.history.append(sample)
+        self.sample_event.set()
+        for callback in self.callbacks:
+            callback(sample)
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(sample)
+
+    def parse_treadmill_data(self, byte_array):
+        return ftms.parse_treadmill_data(byte_array)
+
+    def parse_treadmill_sample(self, byte_array):
+        flags = byte_array[:2]
+        if flags != self.flags:
+            if len(flags) < 2:
+                raise ValueError("Input byte array is too short to contain valid flags")
+            self.expect_flags(flags)
+        return self.layout.unpack_sample(byte_array, time.monotonic())
+
+    def expect_flags(self, flags):
+        # Prepares the layout for packets with these flags, e.g. from the machine features
+        self.layout = ftms.get_treadmill_data_layout(flags[0], flags[1])
+        self.flags = bytes(flags)
+
+class FitnessMachineControlPoint(object):
+    # If the characteristic supports indications, the pad answers every command with a
+    # response (0x80, op code, result code). start() subscribes to them and requests control
+    # once per connection. Commands then wait for their response, only one is in flight at a
+    # time. Missing responses and failed operations are sent again up to `retries` times, if
+    # the pad lost control to another client it is requested again first. Pads without
+    # indications get plain writes and unacknowledged results, like pads which advertise
+    # them but, according to the device cache, don't answer Request Control.
+
+    def __init__(self, client, machine_control_point_characteristic, response_timeout=1.0, retries=2, logger=None):
+        self.machine_control_point_characteristic = machine_control_point_characteristic
+        self.client = client
+        self.response_timeout = response_timeout
+        self.retries = retries
+        self.logger = logger
+        self.acknowledged = False
+        # Whether Request Control was sent on this connection to find out `acknowledged`
+        self.probed = False
+        self.has_control = False
+        # (op code, future) of the command waiting for its response
+        self.pending = None
+        self.lock = asyncio.Lock()
+
+    async def start(self, acknowledged=None):
+        # `acknowledged` is what the device cache knows, False skips the probe, which would
+        # wait (retries + 1) * response_timeout on every connect
+        properties = getattr(self.machine_control_point_characteristic, "properties", ())
+        if "indicate" not in properties:
+            return
+        if acknowledged is False:
+            self.log("info", "The treadmill didn't answer Request Control before, commands are not acknowledged")
+            return
+        await self.client.start_notify(self.machine_control_point_characteristic, self.response_handler)
+        self.acknowledged = True
+        self.probed = True
+        try:
+            await self.request_control()
+        except asyncio.TimeoutError:
+            # Some pads advertise indications but never send them
+            self.log("info", "No response to Request Control, commands are not acknowledged")
+            self.acknowledged = False
+        except ftms.ControlPointError as e:
+            self.log("warning", str(e))
+
+    def log(self, level, message):
+        if self.logger is not None:
+            getattr(self.logger, level)(message)
+
+    def response_handler(self, sender, data):
+        try:
+            opcode, result, _ = ftms.parse_control_point_response(data)
+        except ValueError as e:
+            self.log("debug", str(e))
+            return
+        pending = self.pending
+        if pending is None or pending[0] != opcode or pending[1].done():
+            # Late response to a command which already timed out
+            self.log("debug", "Unexpected response to op code 0x%02x" % opcode)
+            return
+        pending[1].set_result(result)
+
+    async def write(self, data):
+        start = time.perf_counter()
+        try:
+            await self.client.write_gatt_char(self.machine_control_point_characteristic, data, response=False)
+        except Exception:
+            metrics.COMMAND_FAILURES.inc()
+            raise
+        metrics.COMMAND_WRITE_TIME.observe(time.perf_counter() - start)
+
+    async def exchange(self, data):
+        # One write and its response, returns the result code (None if there was no
+        # response) and the round trip time. The lock has to be held.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending = (data[0], future)
+        start = loop.time()
+        try:
+            await self.write(data)
+            result = await asyncio.wait_for(future, self.response_timeout)
+        except asyncio.TimeoutError:
+            result = None
+        finally:
+            self.pending = None
+        return result, loop.time() - start
+
+    async def command(self, data):
+        opcode = data[0]
+        if not self.acknowledged:
+            await self.write(data)
+            return scheduler.CommandResult(opcode)
+        async with self.lock:
+            attempts = 0
+            while True:
+                attempts += 1
+                result, rtt = await self.exchange(data)
+                if result == ftms.RESULT_SUCCESS:
+                    metrics.COMMAND_RTT.observe(rtt)
+                    if opcode == ftms.OP_REQUEST_CONTROL:
+                        self.has_control = True
+                    return scheduler.CommandResult(opcode, result, rtt, attempts)
+                if result is not None:
+                    metrics.COMMAND_REJECTIONS.inc()
+                if result in (ftms.RESULT_NOT_SUPPORTED, ftms.RESULT_INVALID_PARAMETER):
+                    # Sending it again won't change the answer
+                    raise ftms.ControlPointError(opcode, result)
+                if attempts > self.retries:
+                    if result is None:
+                        raise asyncio.TimeoutError("No response to control point op code 0x%02x" % opcode)
+                    raise ftms.ControlPointError(opcode, result)
+                metrics.COMMAND_RETRIES.inc()
+                if result == ftms.RESULT_CONTROL_NOT_PERMITTED and opcode != ftms.OP_REQUEST_CONTROL:
+                    self.has_control = False
+                    self.log("info", "Control of the treadmill was lost, requesting it again")
+                    control, _ = await self.exchange(ftms.build_request_control())
+                    self.has_control = control == ftms.RESULT_SUCCESS
+                self.log("info", "Sending control point op code 0x%02x again (attempt %d)" % (opcode, attempts + 1))
+
+    async def request_control(self):
+        return await self.command(ftms.build_request_control())
+
+    async def send_resume_command(self):
+        return await self.command(ftms.build_start_or_resume())
+
+    async def send_pause_command(self):
+        return await self.command(ftms.build_pause())
+
+    async def send_stop_command(self):
+        return await self.command(ftms.build_stop())
+
+    async def set_speed(self, speed):
+        return await self.command(ftms.build_set_target_speed(speed))
+
+
+class TreadmillController(object):
+    DEVICE_NAME = "EsangLinker"
+    # Characteristics whose handles are kept in the device cache
+    CACHED_CHARACTERISTICS = (ftms.TREADMILL_DATA_UUID, ftms.FITNESS_MACHINE_CONTROL_POINT_UUID,
+                              ftms.FITNESS_MACHINE_STATUS_UUID, ftms.TRAINING_STATUS_UUID,
+                              ftms.FITNESS_MACHINE_FEATURE_UUID)
+    control_point = None
+    treadmill_data_client = None
+    logger = None 
+    client = None
+    was_connected = False
+    # Whether the pad has the Fitness Machine Status characteristic on this connection, whether
+    # it actually sends notifications is in machine_state.has_status
+    status_notifications = False
+
+    def __init__(self, logger, history_size=3600, recorder=None, client_factory=None, scanner_factory=None,
+                 address=None, device_cache=None, connect_timeout=10, scan_timeout=10):
+        self.logger = logger 
+        # Factories default to bleak, they can be replaced e.g. by the simulator
+        self.client_factory = client_factory
+        self.scanner_factory = scanner_factory
+        # Kept across reconnects
+        self.history = history.SampleHistory(history_size)
+        self.recorder = recorder
+        self.address = address
+        self.device_cache = devicecache.DeviceCache(logger=logger) if device_cache is None else device_cache
+        self.connect_timeout = connect_timeout
+        self.scan_timeout = scan_timeout
+        self.characteristics = {}
+        # Survives reconnects, the control point is rebound on every connect
+        self.scheduler = scheduler.CommandScheduler(logger=logger)
+        # Attached to the data client of every connection
+        self.sample_callbacks = []
+        self.disconnect_callbacks = []
+        self.stats = stats.SessionStats()
+        self.add_sample_callback(self.stats.update)
+        self.machine_state = status.MachineState()
+        self.add_sample_callback(self.machine_state.update)
+        self.features = None
+
+    async def connect(self):
+        # Try a directed connect to the configured or last known address first and only
+        # scan if that fails
+        start = time.perf_counter()
+        address = self.address or self.device_cache.last_address
+        if address is not None and await self.connect_to(address):
+            name = self.device_cache.devices.get(address, {}).get("name", self.DEVICE_NAME)
+        else:
+            walking_pad = await self.find_walking_pad()
+            if(walking_pad is None):
+                self.logger.error("Walking pad not found")
+                return None
+            if not await self.connect_to(walking_pad.address):
+                return None
+            address, name = walking_pad.address, walking_pad.name
+        self.logger.info("Connected to " + address)
+        self.stats.mark_reconnect()
+        self.machine_state.reset()
+        try: 
+            self.index_characteristics(self.device_cache.get_handles(address))
+            control_point_characteristic = self.get_fitness_machine_control_point_characteristic()
+            treadmill_data_characteristic = self.get_treadmill_data_characteristic()
+            self.control_point = FitnessMachineControlPoint(self.client, control_point_characteristic,
+                                                            logger=self.logger)
+            self.treadmill_data_client = TreadmillDataClient(self.client, treadmill_data_characteristic, sample_history=self.history)
+            self.features = await self.read_features(address)
+            if self.features is not None:
+                self.treadmill_data_client.expect_flags(self.features.treadmill_data_flags)
+            if self.recorder is not None:
+                self.recorder.attach(self.treadmill_data_client)
+            for callback in self.sample_callbacks:
+                self.treadmill_data_client.add_callback(callback)
+            await self.start_status_notifications()
+            await self.control_point.start(self.device_cache.get_acknowledged(address))
+            # Commands held while disconnected are written now
+            self.scheduler.release(self.control_point)
+            self.device_cache.remember(address, name, {uuid: char.handle for uuid, char in self.characteristics.items()
+                                                       if uuid in self.CACHED_CHARACTERISTICS},
+                                       None if self.features is None else (self.features.machine, self.features.target),
+                                       self.control_point.acknowledged if self.control_point.probed else None)
+            duration = time.perf_counter() - start
+            (metrics.RECONNECT_TIME if self.was_connected else metrics.CONNECT_TIME).observe(duration)
+            self.was_connected = True
+
+        except Exception:
+            # Left to the caller to decide whether it is worth retrying
+            self.logger.exception("Failed to connect.")
+            await self.client.disconnect()
+            raise
+
+    async def read_features(self, address):
+        # The features never change, they are read once per pad and kept in the device cache
+        cached = self.device_cache.get_features(address)
+        if cached is not None:
+            return ftms.FitnessMachineFeatures(*cached)
+        char = self.get_characteristic(ftms.FITNESS_MACHINE_FEATURE_UUID)
+        if char is None:
+            return None
+        try:
+            features = ftms.FitnessMachineFeatures.from_bytes(await self.client.read_gatt_char(char))
+        except Exception as e:
+            self.logger.info("Could not read fitness machine features: " + str(e))
+            return None
+        self.logger.debug("Fitness machine features: " + repr(features))
+        return features
+
+    async def start_status_notifications(self):
+        # State changes are pushed by the pad, nothing has to be polled
+        machine_status = self.get_characteristic(ftms.FITNESS_MACHINE_STATUS_UUID)
+        self.status_notifications = machine_status is not None
+        if machine_status is not None:
+            await self.client.start_notify(machine_status, self.machine_state.machine_status_handler)
+        training_status = self.get_characteristic(ftms.TRAINING_STATUS_UUID)
+        if training_status is not None:
+            await self.client.start_notify(training_status, self.machine_state.training_status_handler)
+
+    def add_sample_callback(self, callback):
+        self.sample_callbacks.append(callback)
+        if self.treadmill_data_client is not None:
+            self.treadmill_data_client.add_callback(callback)
+
+    def add_disconnect_callback(self, callback):
+        # Called with the client when the link is lost or closed
+        self.disconnect_callbacks.append(callback)
+
+    def remove_disconnect_callback(self, callback):
+        self.disconnect_callbacks.remove(callback)
+
+    def handle_disconnect(self, client):
+        if client is not self.client:
+            # A client of an earlier connection
+            return
+        self.scheduler.hold()
+        for callback in self.disconnect_callbacks:
+            callback(client)
+
+    def remove_sample_callback(self, callback):
+        self.sample_callbacks.remove(callback)
+        if self.treadmill_data_client is not None:
+            self.treadmill_data_client.remove_callback(callback)
+
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    async def connect_to(self, address):
+        client_factory = self.client_factory
+        if client_factory is None:
+            from bleak import BleakClient as client_factory
+        self.client = client_factory(address, disconnected_callback=self.handle_disconnect)
+        try:
+            await asyncio.wait_for(self.client.connect(), self.connect_timeout)
+        except Exception as e:
+            metrics.CONNECT_FAILURES.inc()
+            self.logger.info("Could not connect to " + address + ": " + str(e))
+            return False
+        return True
+
+    async def find_walking_pad(self):
+        # Stops scanning as soon as the first walking pad (or the configured one) is seen
+        scanner_factory = self.scanner_factory
+        if scanner_factory is None:
+            from bleak import BleakScanner as scanner_factory
+        scanner = scanner_factory()
+        start = time.perf_counter()
+        if self.address is not None:
+            address = self.address.upper()
+            walking_pad = await scanner.find_device_by_filter(lambda device, advertisement_data: device.address.upper() == address,
+                                                              timeout=self.scan_timeout)
+        else:
+            walking_pad = await scanner.find_device_by_filter(lambda device, advertisement_data: device.name == self.DEVICE_NAME,
+                                                              timeout=self.scan_timeout)
+        metrics.SCAN_TIME.observe(time.perf_counter() - start)
+        if walking_pad is not None:
+            self.logger.debug("Found walking pad: " + walking_pad.address + " " + walking_pad.name)
+        return walking_pad
+
+    def index_characteristics(self, cached_handles=None):
+        # Resolves cached handles directly, otherwise indexes all characteristics by short UUID
+        self.characteristics = {}
+        services = self.client.services
+        if cached_handles:
+            for uuid, handle in cached_handles.items():
+                char = services.get_characteristic(handle)
+                if char is None or char.uuid[:8] != uuid:
+                    self.logger.info("Device cache is outdated, indexing all characteristics.")
+                    break
+                self.characteristics[uuid] = char
+            else:
+                return self.characteristics
+        self.characteristics = {}
+        for service in services:
+            for char in service.characteristics:
+                self.characteristics.setdefault(char.uuid[:8], char)
+        return self.characteristics
+
+    def get_characteristic(self, uuid):
+        if uuid not in self.characteristics:
+            self.index_characteristics()
+        return self.characteristics.get(uuid)
+
+    def get_fitness_machine_control_point_characteristic(self):
+        char = self.get_characteristic(ftms.FITNESS_MACHINE_CONTROL_POINT_UUID)
+        if char is None:
+            self.logger.error("Fitness Machine Control Point characteristic not found")
+        return char
+        
+    def get_treadmill_data_characteristic(self):
+        char = self.get_characteristic(ftms.TREADMILL_DATA_UUID)
+        if char is None:
+            self.logger.error("Treadmill Data characteristic not found")
+        return char
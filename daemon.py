@@ -0,0 +1,407 @@
+import activity
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import stat
+import sys
+
+import export
+import ftms
+import supervisor
+import workout
+
+# A long running process owns the bluetooth connection and publishes decoded samples to
+# any number of local consumers over a Unix domain socket. The protocol is JSON lines in
+# both directions.
+#
+# Daemon -> client:
+#   {"type": "status", "connected": true, "inactive": false, "state": "running", "connection": "connected",
+#    "mode": "active"}
+#   {"type": "sample", "timestamp": 12.5, "data": {"instantaneous_speed": 300, ...}}
+#   {"type": "result", "id": 1, "ok": true, "wait": 0.01, "result": 1, "rtt": 0.05, "attempts": 1}
+# Client -> daemon:
+#   {"id": 1, "command": "set_speed", "args": [300]}
+#   {"command": "subscribe"} / {"command": "unsubscribe"} / {"command": "status"}
+#   {"command": "start_workout", "args": ["/path/to/program.json"]} / {"command": "stop_workout"}
+#   {"command": "history", "args": [7]} -> {"days": [{"key": "2024-05-01", "distance": 5230, ...}, ...], "weeks": [...]}
+
+COMMANDS = ("set_speed", "send_pause_command", "send_resume_command", "send_stop_command")
+
+
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "walkingpad.sock")
+    return "/tmp/walkingpad-%d.sock" % os.getuid()
+
+
+def encode_message(message):
+    return (json.dumps(message, separators=(',', ':')) + "\n").encode()
+
+
+class DaemonError(Exception):
+    pass
+
+
+class Subscriber(object):
+    # One connected client. Messages are queued and written by a separate task, if the
+    # client doesn't keep up the oldest queued messages are dropped.
+
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_size)
+        self.subscribed = True
+        self.dropped = 0
+
+    def send(self, line):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(line)
+
+    async def write_loop(self):
+        while True:
+            line = await self.queue.get()
+            self.writer.write(line)
+            await self.writer.drain()
+
+
+class TreadmillDaemon(object):
+    def __init__(self, controller, socket_path=None, logger=None, interval=1, pause_disconnect_timeout=300,
+                 queue_size=256, exporter=None, history_store=None, paused_interval=5.0, idle_unsubscribe_timeout=60.0):
+        self.controller = controller
+        self.socket_path = default_socket_path() if socket_path is None else socket_path
+        self.logger = logging.getLogger("walkingpad.daemon") if logger is None else logger
+        self.interval = interval
+        self.pause_disconnect_timeout = pause_disconnect_timeout
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.server = None
+        self.last_status = None
+        self.last_sample_line = None
+        self.exporter = exporter
+        self.workout_engine = None
+        self.history_store = history_store
+        # Samples are published at a lower rate while the belt is not running
+        self.activity = activity.ActivityPolicy(controller, paused_interval, idle_unsubscribe_timeout,
+                                                logger=self.logger.getChild("activity"))
+        self.activity.add_sample_callback(self.publish_sample)
+        self.activity.add_callback(self.on_mode_change)
+        # State changes are pushed to the clients right away
+        controller.machine_state.add_callback(self.on_state_change)
+        if exporter is not None:
+            exporter.attach(controller)
+        if history_store is not None:
+            history_store.attach(controller)
+        self.supervisor = supervisor.ConnectionSupervisor(controller, self.logger, interval=interval,
+                                                          idle_timeout=pause_disconnect_timeout)
+        self.supervisor.connect_callbacks.append(self.activity.on_connect)
+        self.supervisor.state_callbacks.append(self.on_connection_state)
+        self.supervisor.idle_callbacks.append(self.on_idle)
+
+    async def start(self):
+        await self.remove_stale_socket()
+        # The path is predictable, the socket is created accessible only by this user
+        umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        finally:
+            os.umask(umask)
+        self.logger.info("Listening on " + self.socket_path)
+
+    async def remove_stale_socket(self):
+        # Only the socket of a previous run which nobody listens on anymore is removed, a
+        # running daemon keeps its socket and the pad
+        try:
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                return
+        except FileNotFoundError:
+            return
+        try:
+            _, writer = await asyncio.open_unix_connection(self.socket_path)
+        except ConnectionRefusedError:
+            self.logger.info("Removing stale socket " + self.socket_path)
+            os.unlink(self.socket_path)
+            return
+        writer.close()
+        raise DaemonError("Another daemon is listening on " + self.socket_path)
+
+    async def run_forever(self):
+        await self.start()
+        try:
+            await self.supervisor.run()
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        self.activity.close()
+        await self.supervisor.disconnect()
+        if self.exporter is not None:
+            self.exporter.close()
+        if self.history_store is not None:
+            self.history_store.close()
+
+    def on_connection_state(self, old, new):
+        self.broadcast_status()
+
+    def on_mode_change(self, old, new):
+        self.broadcast_status()
+
+    def on_idle(self):
+        if self.exporter is not None:
+            self.exporter.finish()
+
+    def status(self):
+        return {"type": "status", "connected": self.controller.is_connected(), "inactive": not self.supervisor.enabled,
+                "state": self.controller.machine_state.state, "connection": self.supervisor.state,
+                "mode": self.activity.mode}
+
+    def broadcast_status(self):
+        status = self.status()
+        if status == self.last_status:
+            return
+        self.last_status = status
+        line = encode_message(status)
+        for subscriber in self.subscribers:
+            subscriber.send(line)
+
+    def on_state_change(self, old, new):
+        self.logger.info("Treadmill " + new)
+        self.broadcast_status()
+
+    def publish_sample(self, sample):
+        # Encoded once for all subscribers
+        line = encode_message({"type": "sample", "timestamp": sample.timestamp, "data": sample.as_dict()})
+        self.last_sample_line = line
+        for subscriber in self.subscribers:
+            if subscriber.subscribed:
+                subscriber.send(line)
+
+    def workout_status(self):
+        engine = self.workout_engine
+        if engine is None or engine.task.done():
+            return None
+        return {"name": engine.program.name, "step": engine.index, "steps": len(engine.program),
+                "remaining": round(engine.remaining(), 1), "suspended": engine.suspended}
+
+    async def handle_client(self, reader, writer):
+        subscriber = Subscriber(writer, self.queue_size)
+        self.subscribers.add(subscriber)
+        write_task = asyncio.get_running_loop().create_task(subscriber.write_loop())
+        subscriber.send(encode_message(self.status()))
+        if self.last_sample_line is not None and self.controller.is_connected():
+            subscriber.send(self.last_sample_line)
+        requests = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # Requests are handled concurrently so speed changes can be coalesced
+                task = asyncio.get_running_loop().create_task(self.respond(subscriber, line))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            write_task.cancel()
+            writer.close()
+
+    async def respond(self, subscriber, line):
+        request = {}
+        try:
+            request = json.loads(line)
+            reply = await self.handle_request(subscriber, request)
+        except Exception as e:
+            reply = {"ok": False, "error": str(e)}
+        if isinstance(request, dict) and "id" in request:
+            reply["id"] = request["id"]
+        reply["type"] = "result"
+        subscriber.send(encode_message(reply))
+
+    async def handle_request(self, subscriber, request):
+        command = request.get("command")
+        args = request.get("args", [])
+        if command == "subscribe":
+            subscriber.subscribed = True
+            return {"ok": True}
+        if command == "unsubscribe":
+            subscriber.subscribed = False
+            return {"ok": True}
+        if command == "status":
+            status = self.status()
+            status.pop("type")
+            status["ok"] = True
+            status["dropped"] = subscriber.dropped
+            status["workout"] = self.workout_status()
+            return status
+        if command == "start_workout":
+            if self.workout_status() is not None:
+                raise DaemonError("A workout is already running")
+            self.workout_engine = workout.WorkoutEngine(self.controller, workout.load_program(args[0]),
+                                                        logger=self.logger.getChild("workout"))
+            self.workout_engine.start_task()
+            return {"ok": True}
+        if command == "stop_workout":
+            if self.workout_engine is not None:
+                await self.workout_engine.cancel()
+                self.workout_engine = None
+            return {"ok": True}
+        if command == "history":
+            if self.history_store is None:
+                raise DaemonError("No history database configured")
+            count = int(args[0]) if args else 7
+            return {"ok": True, "days": [day.as_dict() for day in self.history_store.last_days(count)],
+                    "weeks": self.history_store.weekly_active_minutes()}
+        if command == "disconnect":
+            await self.supervisor.disconnect()
+            if self.exporter is not None:
+                self.exporter.finish()
+            return {"ok": True}
+        if command not in COMMANDS:
+            raise DaemonError("Unknown command " + str(command))
+        if command == "send_resume_command" and not self.controller.is_connected():
+            # Reconnect first, the resume is sent once connected
+            self.supervisor.enable(resume=True)
+            return {"ok": True, "reconnecting": True}
+        if not self.controller.is_connected():
+            raise DaemonError("Treadmill not connected")
+        result = await self.controller.scheduler.submit(command, *args)
+        reply = result.as_dict()
+        reply["ok"] = True
+        return reply
+
+
+class DaemonClient(object):
+    # Client side of the daemon socket, used by the status bar module and other consumers
+
+    def __init__(self, socket_path=None, queue_size=256):
+        self.socket_path = default_socket_path() if socket_path is None else socket_path
+        self.queue_size = queue_size
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.queue = None
+        self.pending = {}
+        self.ids = itertools.count(1)
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+        self.queue = asyncio.Queue(self.queue_size)
+        self.read_task = asyncio.get_running_loop().create_task(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message.get("type") == "result" and message.get("id") in self.pending:
+                    future = self.pending.pop(message["id"])
+                    if not future.done():
+                        future.set_result(message)
+                    continue
+                if self.queue.full():
+                    self.queue.get_nowait()
+                self.queue.put_nowait(message)
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to daemon lost"))
+            self.pending = {}
+            # Ends messages(), also if the consumer fell behind
+            if self.queue.full():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def messages(self):
+        # Yields status and sample messages until the connection is closed
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                return
+            yield message
+
+    async def samples(self):
+        async for message in self.messages():
+            if message.get("type") == "sample":
+                yield ftms.TreadmillSample(message["timestamp"], **message["data"])
+
+    async def command(self, command, *args):
+        if self.read_task is None or self.read_task.done():
+            # Nobody would resolve the reply
+            raise ConnectionError("Not connected to the daemon")
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(encode_message({"id": request_id, "command": command, "args": list(args)}))
+        await self.writer.drain()
+        reply = await future
+        if not reply.get("ok"):
+            raise DaemonError(reply.get("error", "Command failed"))
+        return reply
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.read_task is not None:
+            try:
+                await self.read_task
+            except Exception:
+                pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share one walking pad connection over a Unix domain socket")
+    parser.add_argument('--socket', default=None, help="socket path (default: %s)" % default_socket_path())
+    parser.add_argument('--address', default=None, help="bluetooth address of the walking pad")
+    parser.add_argument('--pause-disconnect-timeout', type=float, default=300)
+    parser.add_argument('--paused-interval', type=float, default=5,
+                        help="seconds between published samples while the belt is not running")
+    parser.add_argument('--idle-unsubscribe-timeout', type=float, default=60,
+                        help="stop the treadmill data notifications after the belt hasn't been running this long")
+    parser.add_argument('--export-dir', default=None, help="write every workout to this directory")
+    parser.add_argument('--export-format', action='append', choices=export.FORMATS,
+                        help="export format, can be repeated (default: all)")
+    parser.add_argument('--history-db', default=None, help="keep the walking history in this SQLite database")
+    parser.add_argument('--log-level', default="INFO")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    from controller import TreadmillController
+    logger = logging.getLogger("walkingpad")
+    controller = TreadmillController(logger.getChild("controller"), address=args.address)
+    exporter = None
+    if args.export_dir:
+        exporter = export.WorkoutExporter(args.export_dir, args.export_format or export.FORMATS,
+                                          logger=logger.getChild("export"))
+    history_store = None
+    if args.history_db:
+        import historydb
+        history_store = historydb.HistoryStore(args.history_db, logger=logger.getChild("history"))
+    daemon = TreadmillDaemon(controller, args.socket, logger.getChild("daemon"),
+                             pause_disconnect_timeout=args.pause_disconnect_timeout, exporter=exporter,
+                             history_store=history_store, paused_interval=args.paused_interval,
+                             idle_unsubscribe_timeout=args.idle_unsubscribe_timeout)
+    try:
+        asyncio.run(daemon.run_forever())
+    except DaemonError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import json
+import os
+import time
+
+
+def default_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "walkingpad-client", "devices.json")
+
+
+class DeviceCache(object):
+    # Persists the address of known walking pads and the handles of their resolved
+    # characteristics, so reconnects can skip scanning and service lookups. "acknowledged"
+    # is whether the pad answered the control point probe. A single lost response must not
+    # turn acknowledgements off for good, a pad is only taken as never answering after
+    # `probe_failures` failed probes in a row, and that is probed again after
+    # `probe_max_age` seconds.
+    #
+    # {"last_address": "...",
+    #  "devices": {"<address>": {"name": "...", "handles": {"00002acd": 14}, "features": [1234, 1],
+    #                            "acknowledged": false, "probe_failures": 3, "probed_at": 1700000000.0}}}
+
+    def __init__(self, path=None, logger=None, probe_failures=3, probe_max_age=7 * 86400):
+        self.path = default_cache_path() if path is None else path
+        self.logger = logger
+        self.probe_failures = probe_failures
+        self.probe_max_age = probe_max_age
+        self.last_address = None
+        self.devices = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+            self.last_address = content.get("last_address")
+            self.devices = content.get("devices", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError):
+            if self.logger is not None:
+                self.logger.warning("Ignoring unreadable device cache " + self.path)
+
+    def save(self):
+        content = {"last_address": self.last_address, "devices": self.devices}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(content, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError:
+            if self.logger is not None:
+                self.logger.warning("Failed to write device cache " + self.path)
+
+    def get_handles(self, address):
+        return self.devices.get(address, {}).get("handles", {})
+
+    def get_features(self, address):
+        # Fitness machine and target setting feature bits, or None if they were never read
+        features = self.devices.get(address, {}).get("features")
+        if features is None:
+            return None
+        return tuple(features)
+
+    def get_acknowledged(self, address, now=None):
+        # None if the pad should be probed
+        entry = self.devices.get(address, {})
+        acknowledged = entry.get("acknowledged")
+        if acknowledged is False:
+            now = time.time() if now is None else now
+            if (entry.get("probe_failures", 0) < self.probe_failures or
+                    now - entry.get("probed_at", 0) > self.probe_max_age):
+                return None
+        return acknowledged
+
+    def remember(self, address, name, handles, features=None, acknowledged=None):
+        # `acknowledged` is the result of a probe on this connection, None if there was none
+        previous = self.devices.get(address, {})
+        entry = {"name": name, "handles": handles}
+        if features is not None:
+            entry["features"] = list(features)
+        if acknowledged is None:
+            for key in ("acknowledged", "probe_failures", "probed_at"):
+                if key in previous:
+                    entry[key] = previous[key]
+        elif acknowledged:
+            entry["acknowledged"] = True
+        else:
+            entry["acknowledged"] = False
+            entry["probe_failures"] = previous.get("probe_failures", 0) + 1
+            entry["probed_at"] = time.time()
+        if self.last_address == address and self.devices.get(address) == entry:
+            return
+        self.last_address = address
+        self.devices[address] = entry
+        self.save()
+
+    def forget(self, address):
+        self.devices.pop(address, None)
+        if self.last_address == address:
+            self.last_address = None
+        self.save()
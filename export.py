@@ -0,0 +1,398 @@
+import collections
+import os
+import struct
+import threading
+import time
+
+import stats
+
+# Streaming workout exporters. The sample callback only queues the decoded samples, a
+# writer thread formats them and writes every batch with one write per file. Each format
+# is written incrementally, the session summaries are patched in when the workout ends.
+
+FORMATS = ("tcx", "fit", "csv")
+
+# Signals the writer thread to finish the current session
+FINISH = object()
+
+
+class CsvWriter(object):
+    extension = "csv"
+    header = "time,elapsed,speed_kmh,distance_m,calories_kcal\n"
+
+    def __init__(self, path, start_time):
+        self.file = open(path, 'w')
+        self.file.write(self.header)
+
+    def format_point(self, point):
+        return "%s,%d,%.2f,%.1f,%d\n" % (point.time_string, point.elapsed, point.speed, point.distance, point.calories)
+
+    def write(self, points):
+        self.file.write("".join(self.format_point(point) for point in points))
+        self.file.flush()
+
+    def finish(self, summary):
+        self.file.close()
+
+
+class TcxWriter(object):
+    extension = "tcx"
+    # The lap totals come before the track in TCX, they are written as fixed width
+    # placeholders and overwritten when the session is finished
+    header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">\n'
+              '  <Activities>\n'
+              '    <Activity Sport="Running">\n'
+              '      <Id>%s</Id>\n'
+              '      <Lap StartTime="%s">\n')
+    totals = ('        <TotalTimeSeconds>%012.1f</TotalTimeSeconds>\n'
+              '        <DistanceMeters>%012.1f</DistanceMeters>\n'
+              '        <MaximumSpeed>%08.3f</MaximumSpeed>\n'
+              '        <Calories>%05d</Calories>\n')
+    track = ('        <Intensity>Active</Intensity>\n'
+             '        <TriggerMethod>Manual</TriggerMethod>\n'
+             '        <Track>\n')
+    trackpoint = ('          <Trackpoint>\n'
+                  '            <Time>%s</Time>\n'
+                  '            <DistanceMeters>%.1f</DistanceMeters>\n'
+                  '            <Extensions><TPX xmlns="http://www.garmin.com/xmlschemas/ActivityExtension/v2">'
+                  '<Speed>%.3f</Speed></TPX></Extensions>\n'
+                  '          </Trackpoint>\n')
+    footer = ('        </Track>\n'
+              '      </Lap>\n'
+              '    </Activity>\n'
+              '  </Activities>\n'
+              '</TrainingCenterDatabase>\n')
+
+    def __init__(self, path, start_time):
+        self.file = open(path, 'w')
+        start = format_time(start_time)
+        self.file.write(self.header % (start, start))
+        self.totals_offset = self.file.tell()
+        self.file.write(self.totals % (0, 0, 0, 0))
+        self.file.write(self.track)
+
+    def write(self, points):
+        self.file.write("".join(self.trackpoint % (point.time_string, point.distance, point.speed / 3.6)
+                                for point in points))
+        self.file.flush()
+
+    def finish(self, summary):
+        self.file.write(self.footer)
+        self.file.seek(self.totals_offset)
+        self.file.write(self.totals % (summary.active_time, summary.distance, summary.max_speed / 360.0,
+                                       min(summary.calories, 99999)))
+        self.file.close()
+
+
+# FIT timestamps are seconds since 1989-12-31 00:00:00 UTC
+FIT_EPOCH = 631065600
+
+
+def fit_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+FIT_CRC_TABLE = fit_crc_table()
+
+
+def fit_crc(data, crc=0):
+    table = FIT_CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class FitMessage(object):
+    # One local message type with its definition, fields are (number, struct format, base type)
+
+    def __init__(self, local_type, global_number, fields):
+        self.local_type = local_type
+        self.struct = struct.Struct('<B' + ''.join(fmt for _, fmt, _ in fields))
+        definition = struct.pack('<BBBHB', 0x40 | local_type, 0, 0, global_number, len(fields))
+        for number, fmt, base_type in fields:
+            definition += struct.pack('<BBB', number, struct.calcsize('<' + fmt), base_type)
+        self.definition = definition
+
+    def pack(self, *values):
+        return self.struct.pack(self.local_type, *values)
+
+
+FIT_ENUM, FIT_UINT8, FIT_UINT16, FIT_UINT32, FIT_UINT32Z = 0x00, 0x02, 0x84, 0x86, 0x8C
+
+FIT_FILE_ID = FitMessage(0, 0, ((0, 'B', FIT_ENUM), (1, 'H', FIT_UINT16), (2, 'H', FIT_UINT16),
+                                (3, 'I', FIT_UINT32Z), (4, 'I', FIT_UINT32)))
+FIT_EVENT = FitMessage(1, 21, ((253, 'I', FIT_UINT32), (0, 'B', FIT_ENUM), (1, 'B', FIT_ENUM)))
+# timestamp, distance (1/100 m), speed (1/1000 m/s), calories (kcal)
+FIT_RECORD = FitMessage(2, 20, ((253, 'I', FIT_UINT32), (5, 'I', FIT_UINT32), (6, 'H', FIT_UINT16),
+                                (33, 'H', FIT_UINT16)))
+# timestamp, start time, elapsed time, timer time (1/1000 s), distance, calories, event, event type
+FIT_LAP = FitMessage(3, 19, ((253, 'I', FIT_UINT32), (2, 'I', FIT_UINT32), (7, 'I', FIT_UINT32),
+                             (8, 'I', FIT_UINT32), (9, 'I', FIT_UINT32), (11, 'H', FIT_UINT16),
+                             (0, 'B', FIT_ENUM), (1, 'B', FIT_ENUM)))
+# as the lap plus sport, sub sport, first lap index, number of laps, average and max speed
+FIT_SESSION = FitMessage(4, 18, ((253, 'I', FIT_UINT32), (2, 'I', FIT_UINT32), (7, 'I', FIT_UINT32),
+                                 (8, 'I', FIT_UINT32), (9, 'I', FIT_UINT32), (11, 'H', FIT_UINT16),
+                                 (0, 'B', FIT_ENUM), (1, 'B', FIT_ENUM), (5, 'B', FIT_ENUM), (6, 'B', FIT_ENUM),
+                                 (25, 'H', FIT_UINT16), (26, 'H', FIT_UINT16), (14, 'H', FIT_UINT16),
+                                 (15, 'H', FIT_UINT16)))
+# timestamp, timer time, number of sessions, type, event, event type
+FIT_ACTIVITY = FitMessage(5, 34, ((253, 'I', FIT_UINT32), (0, 'I', FIT_UINT32), (1, 'H', FIT_UINT16),
+                                  (2, 'B', FIT_ENUM), (3, 'B', FIT_ENUM), (4, 'B', FIT_ENUM)))
+
+FIT_HEADER = struct.Struct('<BBHI4s')
+FIT_PROTOCOL_VERSION = 0x20
+FIT_PROFILE_VERSION = 2132
+# Manufacturer "development", file type activity, sport running, sub sport treadmill
+FIT_MANUFACTURER = 255
+FIT_FILE_TYPE_ACTIVITY = 4
+FIT_SPORT_RUNNING = 1
+FIT_SUB_SPORT_TREADMILL = 1
+FIT_EVENT_TIMER, FIT_EVENT_LAP, FIT_EVENT_SESSION, FIT_EVENT_ACTIVITY = 0, 9, 8, 26
+FIT_EVENT_TYPE_START, FIT_EVENT_TYPE_STOP, FIT_EVENT_TYPE_STOP_ALL = 0, 1, 4
+
+
+class FitWriter(object):
+    extension = "fit"
+
+    def __init__(self, path, start_time):
+        self.file = open(path, 'w+b')
+        self.start = fit_time(start_time)
+        self.data_size = 0
+        # The data size in the header is patched when the session is finished
+        self.file.write(self.build_header())
+        self.append(FIT_FILE_ID.definition + FIT_FILE_ID.pack(FIT_FILE_TYPE_ACTIVITY, FIT_MANUFACTURER, 0,
+                                                              int(start_time) & 0xFFFFFFFF, self.start))
+        self.append(FIT_EVENT.definition + FIT_EVENT.pack(self.start, FIT_EVENT_TIMER, FIT_EVENT_TYPE_START))
+        self.append(FIT_RECORD.definition)
+
+    def build_header(self):
+        header = FIT_HEADER.pack(14, FIT_PROTOCOL_VERSION, FIT_PROFILE_VERSION, self.data_size, b'.FIT')
+        return header + struct.pack('<H', fit_crc(header))
+
+    def append(self, data):
+        self.file.write(data)
+        self.data_size += len(data)
+
+    def write(self, points):
+        pack = FIT_RECORD.pack
+        self.append(b''.join(pack(fit_time(point.time), int(point.distance * 100), int(point.speed / 3.6 * 1000),
+                                  min(point.calories, 0xFFFE))
+                             for point in points))
+        self.file.flush()
+
+    def finish(self, summary):
+        end = fit_time(summary.end_time)
+        elapsed = int((summary.end_time - summary.start_time) * 1000)
+        timer = int(summary.active_time * 1000)
+        distance = int(summary.distance * 100)
+        calories = min(summary.calories, 0xFFFE)
+        self.append(FIT_EVENT.pack(end, FIT_EVENT_TIMER, FIT_EVENT_TYPE_STOP_ALL))
+        self.append(FIT_LAP.definition + FIT_LAP.pack(end, self.start, elapsed, timer, distance, calories,
+                                                      FIT_EVENT_LAP, FIT_EVENT_TYPE_STOP))
+        self.append(FIT_SESSION.definition + FIT_SESSION.pack(
+            end, self.start, elapsed, timer, distance, calories, FIT_EVENT_SESSION, FIT_EVENT_TYPE_STOP,
+            FIT_SPORT_RUNNING, FIT_SUB_SPORT_TREADMILL, 0, 1, int(summary.average_speed / 3.6 * 1000),
+            int(summary.max_speed / 360.0 * 1000)))
+        self.append(FIT_ACTIVITY.definition + FIT_ACTIVITY.pack(end, timer, 1, 0, FIT_EVENT_ACTIVITY,
+                                                                FIT_EVENT_TYPE_STOP))
+        # The file checksum covers the final header, it is computed once over the whole file
+        self.file.seek(0)
+        self.file.write(self.build_header())
+        self.file.seek(0)
+        crc = fit_crc(self.file.read())
+        self.file.write(struct.pack('<H', crc))
+        self.file.close()
+
+
+def fit_time(timestamp):
+    return int(timestamp) - FIT_EPOCH
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + ".%03dZ" % (timestamp % 1 * 1000)
+
+
+WRITERS = {writer.extension: writer for writer in (TcxWriter, FitWriter, CsvWriter)}
+
+
+class ExportPoint(object):
+    __slots__ = ('time', 'time_string', 'elapsed', 'speed', 'distance', 'calories')
+
+    def __init__(self, wall_time, elapsed, speed, distance, calories):
+        self.time = wall_time
+        self.time_string = format_time(wall_time)
+        self.elapsed = elapsed
+        # km/h, meters and kcal since the start of the session
+        self.speed = speed
+        self.distance = distance
+        self.calories = calories
+
+
+class ExportSummary(object):
+    def __init__(self, start_time, end_time, session_stats):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.active_time = session_stats.active_time
+        self.distance = session_stats.distance
+        self.calories = int(session_stats.calories)
+        self.max_speed = session_stats.max_speed
+        self.average_speed = session_stats.average_speed
+
+
+class WorkoutExporter(object):
+    # Writes one file per format and session into `directory`. A session starts with the
+    # first sample of a moving belt and ends with finish(), which is called when the pause
+    # timeout disconnects the walking pad. The next moving sample starts a new session.
+    # Sessions without any active time are deleted instead of finished.
+    #
+    # Points are written at most every `min_interval` seconds, the session totals include
+    # every sample.
+
+    def __init__(self, directory, formats=FORMATS, min_interval=1.0, flush_interval=5.0, flush_size=256,
+                 logger=None):
+        for name in formats:
+            if name not in FORMATS:
+                raise ValueError("Unknown export format " + name)
+        self.directory = directory
+        self.formats = tuple(formats)
+        self.min_interval = min_interval
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.logger = logger
+        self.pending = collections.deque()
+        self.wakeup = threading.Event()
+        self.finished = threading.Event()
+        self.closed = False
+        self.writers = []
+        self.paths = []
+        self.finished_paths = []
+        self.stats = None
+        self.start_time = None
+        self.last_time = None
+        self.last_point = None
+        self.thread = threading.Thread(target=self.writer_thread, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_sample(self, sample, wall_time=None):
+        # Called for every notification, only queues the sample with the wall clock time it
+        # arrived at. Sample timestamps are monotonic, which stops during suspend.
+        self.pending.append((time.time() if wall_time is None else wall_time, sample))
+        if len(self.pending) >= self.flush_size:
+            self.wakeup.set()
+
+    def attach(self, controller):
+        controller.add_sample_callback(self.add_sample)
+
+    def finish(self):
+        # Ends the current session, the files are complete once `finished` is set
+        self.finished.clear()
+        self.pending.append(FINISH)
+        self.wakeup.set()
+
+    def writer_thread(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.process()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.exception("Failed to export workout: " + str(e))
+                self.abort()
+            if self.closed and not self.pending:
+                return
+
+    def process(self):
+        points = []
+        while self.pending:
+            item = self.pending.popleft()
+            if item is FINISH:
+                self.write_points(points)
+                points = []
+                self.finish_session()
+                continue
+            point = self.update(item[1], item[0])
+            if point is not None:
+                points.append(point)
+        self.write_points(points)
+
+    def update(self, sample, wall_time):
+        if not self.writers:
+            if not sample.instantaneous_speed:
+                # Connecting to a standing belt is no workout
+                return None
+            self.start_session(wall_time)
+        self.stats.update(sample)
+        self.last_time = wall_time
+        if self.last_point is not None and wall_time - self.last_point < self.min_interval:
+            return None
+        self.last_point = wall_time
+        return ExportPoint(wall_time, int(wall_time - self.start_time), sample.instantaneous_speed / 100,
+                           self.stats.distance, int(self.stats.calories))
+
+    def start_session(self, wall_time):
+        os.makedirs(self.directory, exist_ok=True)
+        name = time.strftime("walkingpad-%Y%m%d-%H%M%S", time.localtime(wall_time))
+        self.stats = stats.SessionStats()
+        self.start_time = wall_time
+        self.last_point = None
+        self.paths = [os.path.join(self.directory, name + "." + extension) for extension in self.formats]
+        self.writers = [WRITERS[extension](path, wall_time) for extension, path in zip(self.formats, self.paths)]
+        if self.logger is not None:
+            self.logger.info("Exporting workout to " + ", ".join(self.paths))
+
+    def write_points(self, points):
+        if not points:
+            return
+        for writer in self.writers:
+            writer.write(points)
+
+    def finish_session(self):
+        if self.writers and self.stats.active_time <= 0:
+            if self.logger is not None:
+                self.logger.info("Discarding workout without activity " + ", ".join(self.paths))
+            self.abort(remove=True)
+        elif self.writers:
+            summary = ExportSummary(self.start_time, self.last_time, self.stats)
+            for writer in self.writers:
+                writer.finish(summary)
+            self.finished_paths = self.paths
+            if self.logger is not None:
+                self.logger.info("Finished workout " + ", ".join(self.paths))
+        self.writers = []
+        self.paths = []
+        self.finished.set()
+
+    def abort(self, remove=False):
+        for writer in self.writers:
+            writer.file.close()
+        if remove:
+            for path in self.paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self.writers = []
+        self.paths = []
+
+    def close(self):
+        # Finishes the current session and waits for the writer thread
+        if self.closed:
+            return
+        self.finish()
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
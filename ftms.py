@@ -0,0 +1,323 @@
+import struct
+import time
+
+# Short UUIDs of the Fitness Machine Service characteristics
+FITNESS_MACHINE_FEATURE_UUID = "00002acc"
+TREADMILL_DATA_UUID = "00002acd"
+TRAINING_STATUS_UUID = "00002ad3"
+FITNESS_MACHINE_CONTROL_POINT_UUID = "00002ad9"
+FITNESS_MACHINE_STATUS_UUID = "00002ada"
+
+# Fitness Machine Control Point op codes
+OP_REQUEST_CONTROL = 0x00
+OP_SET_TARGET_SPEED = 0x02
+OP_START_OR_RESUME = 0x07
+OP_STOP_OR_PAUSE = 0x08
+STOP = 0x01
+PAUSE = 0x02
+
+# Control Point response indications are (OP_RESPONSE_CODE, request op code, result code)
+OP_RESPONSE_CODE = 0x80
+RESULT_SUCCESS = 0x01
+RESULT_NOT_SUPPORTED = 0x02
+RESULT_INVALID_PARAMETER = 0x03
+RESULT_FAILED = 0x04
+RESULT_CONTROL_NOT_PERMITTED = 0x05
+RESULT_NAMES = {
+    RESULT_SUCCESS: "success",
+    RESULT_NOT_SUPPORTED: "op code not supported",
+    RESULT_INVALID_PARAMETER: "invalid parameter",
+    RESULT_FAILED: "operation failed",
+    RESULT_CONTROL_NOT_PERMITTED: "control not permitted",
+}
+
+# Fitness Machine Status op codes, STATUS_STOPPED_OR_PAUSED is followed by STOP or PAUSE
+STATUS_RESET = 0x01
+STATUS_STOPPED_OR_PAUSED = 0x02
+STATUS_STOPPED_BY_SAFETY_KEY = 0x03
+STATUS_STARTED_OR_RESUMED = 0x04
+STATUS_TARGET_SPEED_CHANGED = 0x05
+STATUS_CONTROL_PERMISSION_LOST = 0xFF
+
+# Training Status values, everything between idle and pre-workout is a workout in progress
+TRAINING_STATUS_OTHER = 0x00
+TRAINING_STATUS_IDLE = 0x01
+TRAINING_STATUS_MANUAL_MODE = 0x0D
+TRAINING_STATUS_PRE_WORKOUT = 0x0E
+TRAINING_STATUS_POST_WORKOUT = 0x0F
+
+# Fitness Machine Feature bits which add fields to the Treadmill Data characteristic.
+# Every entry is (feature bit, flags byte index, flag bits).
+FEATURE_TREADMILL_DATA_FLAGS = (
+    (0x0001, 0, 0x02),  # average speed
+    (0x0004, 0, 0x04),  # total distance
+    (0x0008, 0, 0x08),  # inclination
+    (0x0010, 0, 0x10),  # elevation gain
+    (0x0020, 0, 0x60),  # pace
+    (0x0200, 0, 0x80),  # expended energy
+    (0x0400, 1, 0x01),  # heart rate
+    (0x0800, 1, 0x02),  # metabolic equivalent
+    (0x1000, 1, 0x04),  # elapsed time
+    (0x2000, 1, 0x08),  # remaining time
+    (0x8000, 1, 0x10),  # force on belt and power output
+)
+TARGET_SPEED_SUPPORTED = 0x0001
+
+# Fields of the FTMS Treadmill Data characteristic (0x2ACD) in the order they appear in a packet.
+# Every entry is (flags byte index, flag bit, ((field name, struct format), ...)).
+# Total Distance is a 24 bit value and is unpacked as a uint16 and a uint8 which are combined afterwards.
+TREADMILL_DATA_FIELDS = (
+    (0, 0x02, (('average_speed', 'H'),)),
+    (0, 0x04, (('total_distance', 'H'), ('_total_distance_high', 'B'))),
+    (0, 0x08, (('inclination', 'h'), ('ramp_angle', 'h'))),
+    (0, 0x10, (('elevation_gain', 'H'), ('negative_elevation_gain', 'H'))),
+    (0, 0x20, (('instantaneous_pace', 'B'),)),
+    (0, 0x40, (('average_pace', 'B'),)),
+    (0, 0x80, (('expended_energy', 'H'), ('energy_per_hour', 'H'), ('energy_per_minute', 'B'))),
+    (1, 0x01, (('heart_rate', 'B'),)),
+    (1, 0x02, (('metabolic_equivalent', 'B'),)),
+    (1, 0x04, (('elapsed_time', 'H'),)),
+    (1, 0x08, (('remaining_time', 'H'),)),
+    (1, 0x10, (('force_on_belt', 'h'), ('power_output', 'h'))),
+)
+
+# Public field names in packet order
+TREADMILL_DATA_FIELD_NAMES = ('instantaneous_speed',) + tuple(
+    name for _, _, fields in TREADMILL_DATA_FIELDS for name, _ in fields if not name.startswith('_'))
+
+# Flag bits which change the packet layout. All other bits are ignored by the decoder.
+FLAGS_BYTE1_MASK = 0xFE
+FLAGS_BYTE2_MASK = 0x1F
+
+
+class TreadmillSample(object):
+    # Compact record for one Treadmill Data packet. Fields not present in the packet are None.
+    __slots__ = ('timestamp',) + TREADMILL_DATA_FIELD_NAMES
+
+    def __init__(self, timestamp=None, **fields):
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        for name in TREADMILL_DATA_FIELD_NAMES:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("Unknown treadmill data fields: " + ", ".join(fields))
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def as_dict(self):
+        data = {}
+        for name in TREADMILL_DATA_FIELD_NAMES:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+    def __eq__(self, other):
+        if not isinstance(other, TreadmillSample):
+            return NotImplemented
+        return self.timestamp == other.timestamp and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return "TreadmillSample(timestamp=%r, %s)" % (
+            self.timestamp, ", ".join("%s=%r" % item for item in self.as_dict().items()))
+
+
+class TreadmillDataLayout(object):
+    __slots__ = ('flags', 'struct', 'names', 'has_distance', 'sample_names', 'distance_high_index', 'missing')
+
+    def __init__(self, flags_byte1, flags_byte2):
+        self.flags = (flags_byte1, flags_byte2)
+        # The instantaneous speed is always present
+        fmt = '<H'
+        names = ['instantaneous_speed']
+        flags = (flags_byte1, flags_byte2)
+        for byte_index, bit, fields in TREADMILL_DATA_FIELDS:
+            if flags[byte_index] & bit:
+                for name, field_fmt in fields:
+                    fmt += field_fmt
+                    names.append(name)
+        self.struct = struct.Struct(fmt)
+        self.names = tuple(names)
+        self.has_distance = bool(flags_byte1 & 0x04)
+        # The high byte of the distance has no slot on the sample, it is merged into total_distance
+        self.sample_names = tuple(None if name.startswith('_') else name for name in names)
+        self.distance_high_index = names.index('_total_distance_high') if self.has_distance else None
+        self.missing = tuple(name for name in TREADMILL_DATA_FIELD_NAMES if name not in names)
+
+    @property
+    def size(self):
+        return self.struct.size + 2
+
+    def unpack(self, byte_array):
+        # Unpacks all fields in one call, directly from the given buffer
+        values = self.struct.unpack_from(byte_array, 2)
+        data = dict(zip(self.names, values))
+        if self.has_distance:
+            data['total_distance'] |= data.pop('_total_distance_high') << 16
+        return data
+
+    def pack(self, data):
+        # Inverse of unpack, used to build synthetic packets
+        values = []
+        for name in self.names:
+            if name == 'total_distance':
+                values.append(data[name] & 0xFFFF)
+            elif name == '_total_distance_high':
+                values.append((data['total_distance'] >> 16) & 0xFF)
+            else:
+                values.append(data[name])
+        return bytes(self.flags) + self.struct.pack(*values)
+
+    def unpack_sample(self, byte_array, timestamp):
+        values = self.struct.unpack_from(byte_array, 2)
+        sample = object.__new__(TreadmillSample)
+        sample.timestamp = timestamp
+        for name, value in zip(self.sample_names, values):
+            if name is not None:
+                setattr(sample, name, value)
+        for name in self.missing:
+            setattr(sample, name, None)
+        if self.has_distance:
+            sample.total_distance |= values[self.distance_high_index] << 16
+        return sample
+
+
+class FitnessMachineFeatures(object):
+    # Content of the Fitness Machine Feature characteristic (0x2ACC)
+    __slots__ = ('machine', 'target')
+    FORMAT = struct.Struct('<II')
+
+    def __init__(self, machine=0, target=0):
+        self.machine = machine
+        self.target = target
+
+    @classmethod
+    def from_bytes(cls, byte_array):
+        if len(byte_array) < cls.FORMAT.size:
+            raise ValueError("Fitness machine features must be %d bytes" % cls.FORMAT.size)
+        return cls(*cls.FORMAT.unpack_from(byte_array))
+
+    def to_bytes(self):
+        return self.FORMAT.pack(self.machine, self.target)
+
+    @property
+    def treadmill_data_flags(self):
+        # Flags of the Treadmill Data packets a pad with these features sends
+        flags = [0, 0]
+        for feature_bit, byte_index, flag_bits in FEATURE_TREADMILL_DATA_FLAGS:
+            if self.machine & feature_bit:
+                flags[byte_index] |= flag_bits
+        return tuple(flags)
+
+    @property
+    def supported_fields(self):
+        return tuple(name for name in get_treadmill_data_layout(*self.treadmill_data_flags).sample_names
+                     if name is not None)
+
+    @property
+    def supports_target_speed(self):
+        return bool(self.target & TARGET_SPEED_SUPPORTED)
+
+    def __eq__(self, other):
+        if not isinstance(other, FitnessMachineFeatures):
+            return NotImplemented
+        return self.machine == other.machine and self.target == other.target
+
+    def __repr__(self):
+        return "FitnessMachineFeatures(machine=0x%08x, target=0x%08x)" % (self.machine, self.target)
+
+
+_layouts = {}
+
+
+def get_treadmill_data_layout(flags_byte1, flags_byte2):
+    key = (flags_byte1 & FLAGS_BYTE1_MASK, flags_byte2 & FLAGS_BYTE2_MASK)
+    layout = _layouts.get(key)
+    if layout is None:
+        layout = _layouts[key] = TreadmillDataLayout(*key)
+    return layout
+
+
+def parse_treadmill_data(byte_array):
+    # Ensure we have at least two bytes for the flags
+    if len(byte_array) < 2:
+        raise ValueError("Input byte array is too short to contain valid flags")
+    return get_treadmill_data_layout(byte_array[0], byte_array[1]).unpack(memoryview(byte_array))
+
+
+def parse_treadmill_sample(byte_array, timestamp=None):
+    if len(byte_array) < 2:
+        raise ValueError("Input byte array is too short to contain valid flags")
+    if timestamp is None:
+        timestamp = time.monotonic()
+    return get_treadmill_data_layout(byte_array[0], byte_array[1]).unpack_sample(memoryview(byte_array), timestamp)
+
+
+def build_treadmill_data(data, flags_byte1, flags_byte2):
+    return get_treadmill_data_layout(flags_byte1, flags_byte2).pack(data)
+
+
+def parse_machine_status(byte_array):
+    # Returns the op code and its parameters
+    if len(byte_array) < 1:
+        raise ValueError("Fitness machine status is empty")
+    return byte_array[0], bytes(byte_array[1:])
+
+
+def parse_training_status(byte_array):
+    # Returns the status and the optional status string
+    if len(byte_array) < 2:
+        raise ValueError("Training status is too short")
+    status_string = None
+    if byte_array[0] & 0x01:
+        status_string = bytes(byte_array[2:]).decode('utf-8', 'replace')
+    return byte_array[1], status_string
+
+
+# Fitness Machine Control Point commands
+SET_TARGET_SPEED = struct.Struct('<BH')
+
+
+def build_request_control():
+    return bytes((OP_REQUEST_CONTROL,))
+
+
+def build_start_or_resume():
+    return bytes((OP_START_OR_RESUME,))
+
+
+def build_stop():
+    return bytes((OP_STOP_OR_PAUSE, STOP))
+
+
+def build_pause():
+    return bytes((OP_STOP_OR_PAUSE, PAUSE))
+
+
+def build_set_target_speed(speed):
+    # Speed in 0.01 km/h
+    if not 0 <= speed <= 0xFFFF:
+        raise ValueError("Target speed out of range: %r" % speed)
+    return SET_TARGET_SPEED.pack(OP_SET_TARGET_SPEED, speed)
+
+
+def build_control_point_response(opcode, result):
+    return bytes((OP_RESPONSE_CODE, opcode, result))
+
+
+def parse_control_point_response(byte_array):
+    # Returns the request op code, the result code and the response parameters
+    if len(byte_array) < 3 or byte_array[0] != OP_RESPONSE_CODE:
+        raise ValueError("Not a control point response: " + bytes(byte_array).hex())
+    return byte_array[1], byte_array[2], bytes(byte_array[3:])
+
+
+class ControlPointError(Exception):
+    # The pad answered a control point command with an error result code
+
+    def __init__(self, opcode, result):
+        self.opcode = opcode
+        self.result = result
+        Exception.__init__(self, "Control point op code 0x%02x failed: %s" % (
+            opcode, RESULT_NAMES.get(result, "result code 0x%02x" % result)))
@@ -0,0 +1,63 @@
+from array import array
+
+DEFAULT_HISTORY_FIELDS = ('instantaneous_speed', 'total_distance', 'expended_energy', 'elapsed_time')
+
+NAN = float('nan')
+
+
+class SampleHistory(object):
+    # Fixed size ring buffer holding the last `capacity` samples in one preallocated
+    # array per field. Fields which are missing in a sample are stored as NaN.
+
+    def __init__(self, capacity=3600, fields=DEFAULT_HISTORY_FIELDS):
+        if capacity < 1:
+            raise ValueError("History capacity must be at least 1")
+        self.capacity = capacity
+        self.fields = ('timestamp',) + tuple(fields)
+        self.columns = {name: array('d', [NAN]) * capacity for name in self.fields}
+        self._columns = tuple(self.columns.items())
+        self.index = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, sample):
+        index = self.index
+        for name, column in self._columns:
+            value = getattr(sample, name)
+            column[index] = NAN if value is None else value
+        self.index = (index + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    def window(self, field, count=None):
+        # Returns the last `count` values of a field, oldest first, as one or two
+        # memoryviews into the underlying array (two if the window wraps around).
+        if count is None or count > self.count:
+            count = self.count
+        if count <= 0:
+            return ()
+        view = memoryview(self.columns[field])
+        start = self.index - count
+        if start >= 0:
+            return (view[start:self.index],)
+        if self.index == 0:
+            return (view[start:],)
+        return (view[start + self.capacity:], view[:self.index])
+
+    def values(self, field, count=None):
+        result = []
+        for segment in self.window(field, count):
+            result.extend(segment)
+        return result
+
+    def latest(self, field):
+        if self.count == 0:
+            return None
+        value = self.columns[field][self.index - 1]
+        return None if value != value else value
@@ -0,0 +1,296 @@
+import collections
+import datetime
+import sqlite3
+import threading
+import time
+
+import metrics
+import stats
+
+# Long term walking history in an SQLite database. The sample callback only queues the
+# decoded samples, a writer thread inserts them in one transaction per batch and updates
+# per-minute and per-day rollups incrementally. Dashboard queries read the rollups, so
+# they don't depend on the number of raw samples.
+#
+# The database is in WAL mode, queries from other threads don't block the writer.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    timestamp REAL NOT NULL,
+    speed INTEGER NOT NULL,
+    total_distance INTEGER,
+    expended_energy INTEGER,
+    elapsed_time INTEGER
+);
+CREATE INDEX IF NOT EXISTS samples_timestamp ON samples (timestamp);
+CREATE TABLE IF NOT EXISTS minutes (
+    minute INTEGER PRIMARY KEY,
+    distance REAL NOT NULL,
+    active_time REAL NOT NULL,
+    pause_time REAL NOT NULL,
+    speed_time REAL NOT NULL,
+    calories REAL NOT NULL,
+    max_speed INTEGER NOT NULL,
+    samples INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS days (
+    day TEXT PRIMARY KEY,
+    distance REAL NOT NULL,
+    active_time REAL NOT NULL,
+    pause_time REAL NOT NULL,
+    speed_time REAL NOT NULL,
+    calories REAL NOT NULL,
+    max_speed INTEGER NOT NULL,
+    samples INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Distance in meters, times in seconds, speed_time is the speed integral in 0.01 km/h * s
+# and max_speed is in 0.01 km/h like on the wire
+ROLLUP_COLUMNS = ('distance', 'active_time', 'pause_time', 'speed_time', 'calories', 'max_speed', 'samples')
+
+
+def upsert_statement(table, key):
+    updates = ", ".join("%s = max(%s, excluded.%s)" % (name, name, name) if name == 'max_speed'
+                        else "%s = %s + excluded.%s" % (name, name, name) for name in ROLLUP_COLUMNS)
+    return "INSERT INTO %s (%s, %s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s" % (
+        table, key, ", ".join(ROLLUP_COLUMNS), ", ".join("?" * (len(ROLLUP_COLUMNS) + 1)), key, updates)
+
+
+INSERT_SAMPLE = "INSERT INTO samples VALUES (?, ?, ?, ?, ?)"
+UPSERT_MINUTE = upsert_statement("minutes", "minute")
+UPSERT_DAY = upsert_statement("days", "day")
+
+
+def day_key(value):
+    # Days are local dates in ISO format, accepts dates, datetimes and strings
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return str(value)
+
+
+class Rollup(object):
+    # One row of the minutes or days table, `key` is the start of the minute as a wall
+    # clock timestamp or the ISO date
+    __slots__ = ('key',) + ROLLUP_COLUMNS
+
+    def __init__(self, key, distance=0.0, active_time=0.0, pause_time=0.0, speed_time=0.0, calories=0.0,
+                 max_speed=0, samples=0):
+        self.key = key
+        self.distance = distance
+        self.active_time = active_time
+        self.pause_time = pause_time
+        self.speed_time = speed_time
+        self.calories = calories
+        self.max_speed = max_speed
+        self.samples = samples
+
+    def values(self):
+        return [getattr(self, name) for name in ROLLUP_COLUMNS]
+
+    def add(self, other):
+        for name in ROLLUP_COLUMNS:
+            if name == 'max_speed':
+                self.max_speed = max(self.max_speed, other.max_speed)
+            else:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    @property
+    def active_minutes(self):
+        return self.active_time / 60
+
+    @property
+    def average_speed(self):
+        if self.active_time <= 0:
+            return 0.0
+        return self.speed_time / self.active_time / 100
+
+    def as_dict(self):
+        return {
+            'key': self.key,
+            'distance': int(self.distance),
+            'active_minutes': round(self.active_minutes, 1),
+            'pause_minutes': round(self.pause_time / 60, 1),
+            'average_speed': round(self.average_speed, 2),
+            'max_speed': self.max_speed / 100,
+            'calories': int(self.calories),
+        }
+
+    def __repr__(self):
+        return "Rollup(%r, %s)" % (self.key, ", ".join("%s=%r" % (name, getattr(self, name))
+                                                         for name in ROLLUP_COLUMNS))
+
+
+class HistoryStore(object):
+    # Samples are flushed every `flush_interval` seconds or once `flush_size` are queued.
+    # Raw samples older than `retention_days` are deleted, the rollups are kept forever.
+
+    def __init__(self, path, flush_interval=5.0, flush_size=256, retention_days=None, logger=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.retention_days = retention_days
+        self.logger = logger
+        # Connection for queries, it is shared between threads
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader.execute("PRAGMA journal_mode=WAL")
+        self.reader.executescript(SCHEMA)
+        self.read_lock = threading.Lock()
+        self.pending = collections.deque()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.stats = stats.SessionStats(windows=())
+        self.last_minute = None
+        self.last_day = None
+        self.last_prune = 0.0
+        self.thread = threading.Thread(target=self.writer_thread, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_sample(self, sample, wall_time=None):
+        # Called for every notification, only queues the sample. Sample timestamps are
+        # monotonic, the history is stored in the wall clock time the sample arrived at. The
+        # monotonic clock stops during suspend, a fixed offset between the two wouldn't do.
+        self.pending.append((time.time() if wall_time is None else wall_time, sample))
+        if len(self.pending) >= self.flush_size:
+            self.wakeup.set()
+
+    def attach(self, controller):
+        controller.add_sample_callback(self.add_sample)
+
+    def flush(self, timeout=None):
+        # Waits until everything queued so far is committed, not to be called from the event loop
+        done = threading.Event()
+        self.pending.append(done)
+        self.wakeup.set()
+        return done.wait(timeout)
+
+    def writer_thread(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        try:
+            while True:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                try:
+                    self.process(connection)
+                except Exception as e:
+                    if self.logger is not None:
+                        self.logger.exception("Failed to write walking history: " + str(e))
+                if self.closed and not self.pending:
+                    return
+        finally:
+            connection.close()
+
+    def process(self, connection):
+        rows = []
+        minutes = {}
+        days = {}
+        waiting = []
+        while self.pending:
+            item = self.pending.popleft()
+            if isinstance(item, threading.Event):
+                waiting.append(item)
+                continue
+            rows.append(self.update(item[1], item[0], minutes, days))
+        if rows:
+            start = time.perf_counter()
+            with connection:
+                connection.executemany(INSERT_SAMPLE, rows)
+                connection.executemany(UPSERT_MINUTE, ([key] + bucket.values() for key, bucket in minutes.items()))
+                connection.executemany(UPSERT_DAY, ([key] + bucket.values() for key, bucket in days.items()))
+            metrics.HISTORY_WRITE_TIME.observe(time.perf_counter() - start)
+            self.prune(connection)
+        for done in waiting:
+            done.set()
+
+    def update(self, sample, wall_time, minutes, days):
+        session = self.stats
+        before = (session.distance, session.active_time, session.pause_time, session.speed_time_integral,
+                  session.calories)
+        session.update(sample)
+        minute = int(wall_time // 60)
+        if minute != self.last_minute:
+            self.last_minute = minute
+            self.last_day = time.strftime("%Y-%m-%d", time.localtime(wall_time))
+        for buckets, key in ((minutes, minute), (days, self.last_day)):
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = Rollup(key)
+            bucket.distance += session.distance - before[0]
+            bucket.active_time += session.active_time - before[1]
+            bucket.pause_time += session.pause_time - before[2]
+            bucket.speed_time += session.speed_time_integral - before[3]
+            bucket.calories += session.calories - before[4]
+            bucket.max_speed = max(bucket.max_speed, sample.instantaneous_speed)
+            bucket.samples += 1
+        return (wall_time, sample.instantaneous_speed, sample.total_distance, sample.expended_energy,
+                sample.elapsed_time)
+
+    def prune(self, connection):
+        if self.retention_days is None:
+            return
+        now = time.time()
+        if now - self.last_prune < 3600:
+            return
+        self.last_prune = now
+        with connection:
+            connection.execute("DELETE FROM samples WHERE timestamp < ?", (now - self.retention_days * 86400,))
+
+    def query(self, sql, parameters=()):
+        with self.read_lock:
+            return self.reader.execute(sql, parameters).fetchall()
+
+    def daily(self, start, end):
+        # Rollups of the days from start to end, both included. Days without samples are missing.
+        rows = self.query("SELECT day, %s FROM days WHERE day BETWEEN ? AND ? ORDER BY day" % ", ".join(ROLLUP_COLUMNS),
+                          (day_key(start), day_key(end)))
+        return [Rollup(*row) for row in rows]
+
+    def per_minute(self, start_time, end_time):
+        # Rollups of the minutes between two wall clock timestamps
+        rows = self.query("SELECT minute, %s FROM minutes WHERE minute BETWEEN ? AND ? ORDER BY minute" %
+                          ", ".join(ROLLUP_COLUMNS), (int(start_time // 60), int(end_time // 60)))
+        return [Rollup(row[0] * 60, *row[1:]) for row in rows]
+
+    def totals(self, start, end):
+        total = Rollup((day_key(start), day_key(end)))
+        for day in self.daily(start, end):
+            total.add(day)
+        return total
+
+    def last_days(self, count, today=None):
+        # One rollup per day for the last `count` days including today, oldest first
+        today = datetime.date.today() if today is None else today
+        first = today - datetime.timedelta(days=count - 1)
+        found = {day.key: day for day in self.daily(first, today)}
+        keys = [day_key(first + datetime.timedelta(days=offset)) for offset in range(count)]
+        return [found.get(key) or Rollup(key) for key in keys]
+
+    def daily_distance(self, count=7, today=None):
+        return [(day.key, day.distance) for day in self.last_days(count, today)]
+
+    def weekly_active_minutes(self, count=4, today=None):
+        # Active minutes of the last `count` weeks, keyed by the Monday starting the week
+        today = datetime.date.today() if today is None else today
+        first = today - datetime.timedelta(days=today.weekday(), weeks=count - 1)
+        minutes = [0.0] * count
+        for day in self.daily(first, today):
+            week = (datetime.date.fromisoformat(day.key) - first).days // 7
+            minutes[week] += day.active_minutes
+        return [(day_key(first + datetime.timedelta(weeks=week)), minutes[week]) for week in range(count)]
+
+    def close(self):
+        # Writes the queued samples and waits for the writer thread
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        with self.read_lock:
+            self.reader.close()
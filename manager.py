@@ -0,0 +1,133 @@
+import asyncio
+
+import devicecache
+from controller import TreadmillController
+
+
+class TreadmillManager(object):
+    # Drives any number of walking pads from one event loop. Every pad gets its own
+    # TreadmillController (data stream, control point and command scheduler), all of them
+    # share the scanner and the device cache. Pads are addressed by their bluetooth address.
+
+    def __init__(self, logger, addresses=(), client_factory=None, scanner_factory=None, device_cache=None,
+                 scan_timeout=10, max_concurrent_connects=4, **controller_options):
+        self.logger = logger
+        self.client_factory = client_factory
+        # Defaults to bleak, imported on the first scan
+        self.scanner_factory = scanner_factory
+        self.device_cache = devicecache.DeviceCache(logger=logger) if device_cache is None else device_cache
+        self.scan_timeout = scan_timeout
+        self.controller_options = controller_options
+        # Limits parallel connection attempts, many adapters fail if too many are pending
+        self.connect_semaphore = asyncio.Semaphore(max_concurrent_connects)
+        self.controllers = {}
+        self.queues = []
+        for address in addresses:
+            self.add(address)
+
+    def __len__(self):
+        return len(self.controllers)
+
+    def __iter__(self):
+        return iter(self.controllers.values())
+
+    def add(self, address):
+        if address in self.controllers:
+            return self.controllers[address]
+        controller = TreadmillController(self.logger.getChild(address), client_factory=self.client_factory,
+                                         scanner_factory=self.scanner_factory, address=address,
+                                         device_cache=self.device_cache, **self.controller_options)
+        controller.add_sample_callback(lambda sample: self.sample_handler(address, sample))
+        self.controllers[address] = controller
+        return controller
+
+    def get(self, address):
+        try:
+            return self.controllers[address]
+        except KeyError:
+            raise KeyError("Unknown walking pad " + address)
+
+    def add_known_devices(self):
+        # Pads from earlier sessions can be connected without scanning
+        for address in self.device_cache.devices:
+            self.add(address)
+        return list(self.controllers)
+
+    async def discover(self, timeout=None):
+        scanner_factory = self.scanner_factory
+        if scanner_factory is None:
+            from bleak import BleakScanner as scanner_factory
+        scanner = scanner_factory()
+        devices = await scanner.discover(timeout=self.scan_timeout if timeout is None else timeout)
+        found = []
+        for device in devices:
+            if device.name == TreadmillController.DEVICE_NAME and device.address not in self.controllers:
+                self.logger.debug("Found walking pad: " + device.address)
+                self.add(device.address)
+                found.append(device.address)
+        return found
+
+    async def connect_one(self, controller):
+        async with self.connect_semaphore:
+            await controller.connect()
+        if controller.is_connected():
+            await controller.treadmill_data_client.start()
+        return controller.is_connected()
+
+    async def connect_all(self):
+        # Connects all pads which are not connected yet, returns the addresses which failed
+        pending = [controller for controller in self.controllers.values() if not controller.is_connected()]
+        results = await asyncio.gather(*(self.connect_one(controller) for controller in pending), return_exceptions=True)
+        failed = []
+        for controller, result in zip(pending, results):
+            if result is not True:
+                if isinstance(result, Exception):
+                    self.logger.error("Failed to connect to " + controller.address + ": " + str(result))
+                failed.append(controller.address)
+        return failed
+
+    async def disconnect_all(self):
+        await asyncio.gather(*(controller.client.disconnect() for controller in self.controllers.values()
+                               if controller.is_connected()), return_exceptions=True)
+
+    def connected(self):
+        return [address for address, controller in self.controllers.items() if controller.is_connected()]
+
+    def sample_handler(self, address, sample):
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((address, sample))
+
+    async def stream(self, maxsize=0):
+        # Yields (address, sample) for every packet of every pad
+        queue = asyncio.Queue(maxsize)
+        self.queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.queues.remove(queue)
+
+    def latest(self):
+        return {address: controller.treadmill_data_client.sample
+                for address, controller in self.controllers.items()
+                if controller.treadmill_data_client is not None}
+
+    async def send(self, address, command, *args):
+        controller = self.get(address)
+        if not controller.is_connected():
+            raise ConnectionError("Walking pad " + address + " is not connected")
+        return await controller.scheduler.submit(command, *args)
+
+    async def set_speed(self, address, speed):
+        return await self.send(address, "set_speed", speed)
+
+    async def pause(self, address):
+        return await self.send(address, "send_pause_command")
+
+    async def resume(self, address):
+        return await self.send(address, "send_resume_command")
+
+    async def stop(self, address):
+        return await self.send(address, "send_stop_command")
@@ -0,0 +1,205 @@
+import bisect
+import threading
+import time
+
+# Lightweight counters, gauges and histograms for the BLE pipeline. Updating a metric is a
+# plain attribute update (plus a bisect for histograms), so it can be used on the hot path.
+# The registry can be read as a snapshot dict or in the Prometheus text exposition format.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PARSE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+CONNECT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter(object):
+    __slots__ = ('name', 'help', 'value')
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def samples(self):
+        yield self.name + "_total", self.value
+
+
+class Gauge(object):
+    __slots__ = ('name', 'help', 'value')
+    type = "gauge"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Histogram(object):
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # One extra slot for observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket containing the quantile
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket{le="%s"}' % (self.name, repr(float(bound))), cumulative
+        yield '%s_bucket{le="+Inf"}' % self.name, self.count
+        yield self.name + "_sum", self.sum
+        yield self.name + "_count", self.count
+
+
+class MetricsRegistry(object):
+    def __init__(self, prefix="walkingpad_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.last_snapshot = None
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError("Metric " + metric.name + " is already registered as " + existing.type)
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(self.prefix + name, help))
+
+    def gauge(self, name, help):
+        return self.register(Gauge(self.prefix + name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(self.prefix + name, help, buckets))
+
+    def snapshot(self):
+        # Counters also get a per second rate since the previous snapshot
+        now = time.monotonic()
+        with self.lock:
+            metrics = list(self.metrics.values())
+        values = {metric.name: metric.snapshot() for metric in metrics}
+        previous = self.last_snapshot
+        self.last_snapshot = (now, values)
+        if previous is not None and now > previous[0]:
+            elapsed = now - previous[0]
+            for metric in metrics:
+                if metric.type == "counter":
+                    values[metric.name + "_per_second"] = (values[metric.name] - previous[1].get(metric.name, 0)) / elapsed
+        return values
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+NOTIFICATIONS = METRICS.counter("notifications", "Treadmill data notifications received")
+INVALID_PACKETS = METRICS.counter("invalid_packets", "Treadmill data notifications which could not be decoded")
+PARSE_TIME = METRICS.histogram("parse_seconds", "Time to decode a treadmill data notification", PARSE_BUCKETS)
+CONNECT_TIME = METRICS.histogram("connect_seconds", "Time to establish a connection", CONNECT_BUCKETS)
+RECONNECT_TIME = METRICS.histogram("reconnect_seconds", "Time to re-establish a lost connection", CONNECT_BUCKETS)
+SCAN_TIME = METRICS.histogram("scan_seconds", "Time spent scanning for walking pads", CONNECT_BUCKETS)
+CONNECT_FAILURES = METRICS.counter("connect_failures", "Failed connection attempts")
+RECOVERY_TIME = METRICS.histogram("recovery_seconds", "Time from losing the connection until it was re-established",
+                                  CONNECT_BUCKETS)
+FATAL_ERRORS = METRICS.counter("fatal_errors", "Errors which stopped reconnecting")
+COMMAND_QUEUE_DEPTH = METRICS.gauge("command_queue_depth", "Commands waiting to be written")
+COMMAND_WAIT_TIME = METRICS.histogram("command_wait_seconds", "Time commands waited in the scheduler")
+COMMAND_WRITE_TIME = METRICS.histogram("command_write_seconds", "Control point write latency")
+COMMAND_FAILURES = METRICS.counter("command_failures", "Control point writes which failed")
+COMMAND_RTT = METRICS.histogram("command_rtt_seconds", "Time from a control point write to the treadmill's response")
+COMMAND_RETRIES = METRICS.counter("command_retries", "Control point commands which were sent again")
+COMMAND_REJECTIONS = METRICS.counter("command_rejections", "Control point commands answered with an error result")
+THROTTLED_SAMPLES = METRICS.counter("throttled_samples", "Samples not passed on while the belt was not running")
+HISTORY_WRITE_TIME = METRICS.histogram("history_write_seconds", "Time to write a batch of samples to the history database")
+
+
+def request_handler(registry):
+    # http.server is only imported when the endpoint is enabled
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsRequestHandler
+
+
+def start_http_server(port, address="127.0.0.1", registry=METRICS):
+    # Serves the registry in the Prometheus text format from a daemon thread
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((address, port), request_handler(registry))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
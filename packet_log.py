@@ -0,0 +1,111 @@
+import struct
+from array import array
+
+import ftms
+
+# A packet log is a sequence of raw Treadmill Data notifications, each prefixed with its
+# length as a little endian uint16.
+LENGTH_PREFIX = struct.Struct('<H')
+
+_NUMPY_TYPES = {'B': 'u1', 'H': '<u2', 'h': '<i2'}
+
+
+def encode_packet_log(packets):
+    buffer = bytearray()
+    for packet in packets:
+        buffer += LENGTH_PREFIX.pack(len(packet))
+        buffer += packet
+    return buffer
+
+
+def packet_log_from_hex(lines):
+    # Accepts the "Received data: <hex>" lines printed by earlier versions of main.py as well as
+    # bare hex strings
+    packets = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        packets.append(bytes.fromhex(line.rpartition(':')[2].strip()))
+    return encode_packet_log(packets)
+
+
+def packet_offsets(buffer):
+    # Returns the offsets and lengths of all packet payloads in the log as two arrays
+    offsets = array('q')
+    lengths = array('q')
+    position = 0
+    end = len(buffer)
+    unpack_from = LENGTH_PREFIX.unpack_from
+    while position + 2 <= end:
+        length = unpack_from(buffer, position)[0]
+        position += 2
+        if position + length > end:
+            raise ValueError("Truncated packet at offset %d" % (position - 2))
+        offsets.append(position)
+        lengths.append(length)
+        position += length
+    if position != end:
+        raise ValueError("Trailing data at offset %d" % position)
+    return offsets, lengths
+
+
+def iter_packet_log(buffer):
+    view = memoryview(buffer)
+    for offset, length in zip(*packet_offsets(buffer)):
+        yield view[offset:offset + length]
+
+
+def _layout_dtype(np, layout):
+    fields = [('_flags_byte1', 'u1'), ('_flags_byte2', 'u1')]
+    for name, code in zip(layout.names, layout.struct.format.lstrip('<')):
+        fields.append((name, _NUMPY_TYPES[code]))
+    return np.dtype(fields)
+
+
+def decode_packet_log(buffer):
+    # Decodes a whole packet log at once. Packets are grouped by their flags and every group
+    # is decoded with one NumPy structured dtype. Returns a dict of float64 columns with one
+    # entry per packet (NaN where a packet doesn't carry a field), plus the raw 16 bit
+    # 'flags' and a 'valid' mask for packets which were too short to decode.
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError("decode_packet_log requires numpy")
+
+    offsets, lengths = packet_offsets(buffer)
+    count = len(offsets)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    positions = np.frombuffer(offsets, dtype=np.int64)
+    lengths = np.frombuffer(lengths, dtype=np.int64)
+
+    columns = {name: np.full(count, np.nan) for name in ftms.TREADMILL_DATA_FIELD_NAMES}
+    valid = np.zeros(count, dtype=bool)
+    flags = np.zeros(count, dtype=np.uint16)
+
+    has_flags = lengths >= 2
+    flag_positions = positions[has_flags]
+    flags_byte1 = data[flag_positions] & ftms.FLAGS_BYTE1_MASK
+    flags_byte2 = data[flag_positions + 1] & ftms.FLAGS_BYTE2_MASK
+    flags[has_flags] = data[flag_positions] | (data[flag_positions + 1].astype(np.uint16) << 8)
+    keys = np.full(count, -1, dtype=np.int32)
+    keys[has_flags] = flags_byte1.astype(np.int32) | (flags_byte2.astype(np.int32) << 8)
+
+    for key in np.unique(keys[has_flags]):
+        layout = ftms.get_treadmill_data_layout(int(key) & 0xFF, int(key) >> 8)
+        indices = np.flatnonzero((keys == key) & (lengths >= layout.size))
+        if len(indices) == 0:
+            continue
+        rows = data[positions[indices, None] + np.arange(layout.size)]
+        records = rows.view(_layout_dtype(np, layout)).reshape(-1)
+        for name in layout.names:
+            if name.startswith('_'):
+                continue
+            columns[name][indices] = records[name]
+        if layout.has_distance:
+            columns['total_distance'][indices] += records['_total_distance_high'].astype(np.float64) * 65536
+        valid[indices] = True
+
+    columns['flags'] = flags
+    columns['valid'] = valid
+    return columns
@@ -0,0 +1,163 @@
+import mmap
+import struct
+import threading
+import time
+from array import array
+
+import packet_log
+
+# Session files start with MAGIC, followed by records of
+# (wall clock timestamp as float64, payload length as uint16, payload), all little endian.
+MAGIC = b'WPADREC\x01'
+RECORD_HEADER = struct.Struct('<dH')
+
+
+class SessionRecorder(object):
+    # Appends raw Treadmill Data notifications to a session file. The notification callback
+    # only appends to an in-memory buffer, the file is written in batches by a writer thread.
+
+    def __init__(self, path, flush_size=64 * 1024, flush_interval=1.0):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        else:
+            # Cut off an incomplete last record, e.g. after a crash while writing, otherwise
+            # the appended records are read from the wrong offset
+            try:
+                with SessionReader(path) as existing:
+                    end = existing.end
+            except ValueError:
+                self.file.close()
+                raise
+            if end < self.file.tell():
+                self.file.truncate(end)
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.writer_thread, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self.buffer += RECORD_HEADER.pack(timestamp, len(data))
+            self.buffer += data
+            pending = len(self.buffer)
+        if pending >= self.flush_size:
+            self.wakeup.set()
+
+    def raw_data_handler(self, sender, data):
+        self.record(data)
+
+    def attach(self, treadmill_data_client):
+        treadmill_data_client.add_raw_callback(self.raw_data_handler)
+
+    def detach(self, treadmill_data_client):
+        treadmill_data_client.remove_raw_callback(self.raw_data_handler)
+
+    def flush(self):
+        with self.lock:
+            buffer = self.buffer
+            self.buffer = bytearray()
+        if buffer:
+            self.file.write(buffer)
+            self.file.flush()
+
+    def writer_thread(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            if not self.closed:
+                self.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+class SessionReader(object):
+    # Memory maps a session file. Only the record offsets are indexed up front, packets are
+    # returned as memoryviews into the mapping.
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array('q')
+        self.map = None
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + " is not a session recording")
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.build_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def build_index(self):
+        # `end` is the offset after the last complete record
+        position = len(MAGIC)
+        end = len(self.map)
+        unpack_from = RECORD_HEADER.unpack_from
+        while position + RECORD_HEADER.size <= end:
+            length = unpack_from(self.map, position)[1]
+            if position + RECORD_HEADER.size + length > end:
+                # Incomplete last record, e.g. after a crash while writing
+                break
+            self.offsets.append(position)
+            position += RECORD_HEADER.size + length
+        self.end = position
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def record_at(self, offset):
+        timestamp, length = RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size
+        return timestamp, self.view[start:start + length]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.record_at(offset) for offset in self.offsets[index]]
+        return self.record_at(self.offsets[index])
+
+    def __iter__(self):
+        for offset in self.offsets:
+            yield self.record_at(offset)
+
+    def timestamps(self):
+        unpack_from = RECORD_HEADER.unpack_from
+        return array('d', (unpack_from(self.map, offset)[0] for offset in self.offsets))
+
+    def to_packet_log(self):
+        return packet_log.encode_packet_log(packet for _, packet in self)
+
+    def close(self):
+        if self.map is None:
+            return
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Packets handed out by the reader are still referenced, the mapping is
+            # released once they are garbage collected
+            pass
+        self.map = None
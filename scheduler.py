@@ -0,0 +1,214 @@
+import asyncio
+import collections
+
+import metrics
+
+
+class CommandResult(object):
+    # What the future of a submitted command resolves to. `result` is the FTMS result code and
+    # `rtt` the time from the write to the response indication, both are None if the pad
+    # doesn't acknowledge commands. `wait` is the time the command was queued.
+    __slots__ = ('opcode', 'result', 'rtt', 'attempts', 'wait')
+
+    def __init__(self, opcode=None, result=None, rtt=None, attempts=1, wait=None):
+        self.opcode = opcode
+        self.result = result
+        self.rtt = rtt
+        self.attempts = attempts
+        self.wait = wait
+
+    @property
+    def acknowledged(self):
+        return self.result is not None
+
+    def as_dict(self):
+        return {"result": self.result, "rtt": self.rtt, "attempts": self.attempts, "wait": self.wait}
+
+    def __repr__(self):
+        return "CommandResult(opcode=%r, result=%r, rtt=%r, attempts=%r, wait=%r)" % (
+            self.opcode, self.result, self.rtt, self.attempts, self.wait)
+
+
+class ScheduledCommand(object):
+    __slots__ = ('command', 'args', 'futures', 'submitted')
+
+    def __init__(self, command, args, future, submitted):
+        self.command = command
+        self.args = args
+        self.futures = [future]
+        self.submitted = submitted
+
+
+class CommandScheduler(object):
+    # Sits in front of a FitnessMachineControlPoint. Speed changes which are still pending
+    # are merged into the latest target, writes are spaced at least min_interval apart and
+    # pause/resume/stop are sent before any pending speed change.
+    #
+    # Every submitted command returns a future which resolves to a CommandResult with the
+    # time in seconds the command waited before it was written.
+    #
+    # While the link is down (hold() until release()) commands stay queued, a command whose
+    # write failed because the link went down is written again after the reconnect.
+    # Commands older than max_hold seconds are dropped on release.
+
+    def __init__(self, control_point=None, min_interval=0.25, logger=None, max_hold=30.0):
+        self.control_point = control_point
+        self.min_interval = min_interval
+        self.logger = logger
+        self.max_hold = max_hold
+        self.available = asyncio.Event()
+        if control_point is not None:
+            self.available.set()
+        self.priority = collections.deque()
+        self.pending_speed = None
+        self.last_write = None
+        self.last_wait = None
+        self.wait_times = collections.deque(maxlen=100)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    @property
+    def queue_depth(self):
+        return len(self.priority) + (self.pending_speed is not None)
+
+    @property
+    def target_speed(self):
+        if self.pending_speed is None:
+            return None
+        return self.pending_speed.args[0]
+
+    def submit(self, command, *args):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+        future = loop.create_future()
+        now = loop.time()
+        if command == "set_speed" and self.pending_speed is not None:
+            # Coalesce with the pending speed change, the wait is measured from the first one
+            self.pending_speed.args = args
+            self.pending_speed.futures.append(future)
+        elif command == "set_speed":
+            self.pending_speed = ScheduledCommand(command, args, future, now)
+        else:
+            self.priority.append(ScheduledCommand(command, args, future, now))
+        metrics.COMMAND_QUEUE_DEPTH.set(self.queue_depth)
+        self.wakeup.set()
+        return future
+
+    def set_speed(self, speed):
+        return self.submit("set_speed", speed)
+
+    def pause(self):
+        return self.submit("send_pause_command")
+
+    def resume(self):
+        return self.submit("send_resume_command")
+
+    def stop(self):
+        return self.submit("send_stop_command")
+
+    def hold(self):
+        self.available.clear()
+
+    def release(self, control_point):
+        self.control_point = control_point
+        self.expire(asyncio.get_running_loop().time() - self.max_hold)
+        self.available.set()
+        self.wakeup.set()
+
+    def expire(self, deadline):
+        expired = [scheduled for scheduled in self.priority if scheduled.submitted < deadline]
+        for scheduled in expired:
+            self.priority.remove(scheduled)
+        if self.pending_speed is not None and self.pending_speed.submitted < deadline:
+            expired.append(self.pending_speed)
+            self.pending_speed = None
+        for scheduled in expired:
+            if self.logger is not None:
+                self.logger.info("Dropping " + scheduled.command + ", it was held too long")
+            for future in scheduled.futures:
+                if not future.done():
+                    future.set_exception(ConnectionError("Command expired while disconnected"))
+        metrics.COMMAND_QUEUE_DEPTH.set(self.queue_depth)
+
+    def requeue(self, scheduled):
+        if scheduled.command != "set_speed":
+            self.priority.appendleft(scheduled)
+        elif self.pending_speed is None:
+            self.pending_speed = scheduled
+        else:
+            # Superseded by the newer speed change
+            self.pending_speed.futures.extend(scheduled.futures)
+        metrics.COMMAND_QUEUE_DEPTH.set(self.queue_depth)
+
+    def link_lost(self):
+        client = getattr(self.control_point, "client", None)
+        return not self.available.is_set() or (client is not None and not client.is_connected)
+
+    def next_command(self):
+        if self.priority:
+            return self.priority.popleft()
+        command, self.pending_speed = self.pending_speed, None
+        return command
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.queue_depth:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            if not self.available.is_set():
+                await self.available.wait()
+                continue
+            if self.last_write is not None:
+                delay = self.last_write + self.min_interval - loop.time()
+                if delay > 0:
+                    # Speed changes arriving in the meantime are coalesced
+                    await asyncio.sleep(delay)
+            scheduled = self.next_command()
+            metrics.COMMAND_QUEUE_DEPTH.set(self.queue_depth)
+            if scheduled is None:
+                continue
+            start = loop.time()
+            wait = start - scheduled.submitted
+            try:
+                result = await getattr(self.control_point, scheduled.command)(*scheduled.args)
+            except Exception as e:
+                if self.link_lost():
+                    if self.logger is not None:
+                        self.logger.info("Holding " + scheduled.command + " until the treadmill is reconnected")
+                    self.hold()
+                    self.requeue(scheduled)
+                    continue
+                if self.logger is not None:
+                    self.logger.error("Failed to send " + scheduled.command + ": " + str(e))
+                for future in scheduled.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.last_wait = wait
+                self.wait_times.append((scheduled.command, wait))
+                metrics.COMMAND_WAIT_TIME.observe(wait)
+                if result is None:
+                    result = CommandResult()
+                result.wait = wait
+                for future in scheduled.futures:
+                    if not future.done():
+                        future.set_result(result)
+            self.last_write = loop.time()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        for scheduled in list(self.priority) + [self.pending_speed]:
+            if scheduled is None:
+                continue
+            for future in scheduled.futures:
+                if not future.done():
+                    future.cancel()
+        self.priority.clear()
+        self.pending_speed = None
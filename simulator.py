@@ -0,0 +1,394 @@
+import asyncio
+import itertools
+
+import ftms
+
+try:
+    from bleak.exc import BleakError
+except ImportError:
+    # Without bleak the simulated errors are still transient for the supervisor
+    class BleakError(OSError):
+        pass
+
+# In-process stand-in for the parts of bleak used by TreadmillController. A FakeBluetooth
+# holds any number of simulated treadmills and provides client and scanner factories:
+#
+#   bluetooth = FakeBluetooth()
+#   bluetooth.add_treadmill(rate=10)
+#   controller = TreadmillController(logger, client_factory=bluetooth.client,
+#                                    scanner_factory=bluetooth.scanner)
+
+DEVICE_NAME = "EsangLinker"
+SERVICE_UUID = "00001826-0000-1000-8000-00805f9b34fb"
+TREADMILL_DATA_UUID = ftms.TREADMILL_DATA_UUID + "-0000-1000-8000-00805f9b34fb"
+CONTROL_POINT_UUID = ftms.FITNESS_MACHINE_CONTROL_POINT_UUID + "-0000-1000-8000-00805f9b34fb"
+FEATURE_UUID = ftms.FITNESS_MACHINE_FEATURE_UUID + "-0000-1000-8000-00805f9b34fb"
+TRAINING_STATUS_UUID = ftms.TRAINING_STATUS_UUID + "-0000-1000-8000-00805f9b34fb"
+MACHINE_STATUS_UUID = ftms.FITNESS_MACHINE_STATUS_UUID + "-0000-1000-8000-00805f9b34fb"
+
+# Roughly what an idle walking pad reports: speed, distance, energy and elapsed time
+DEFAULT_FLAGS = (0x84, 0x04)
+
+
+def features_for_flags(flags):
+    # The features a pad sending packets with these flags advertises, including speed targets
+    machine = 0
+    for feature_bit, byte_index, flag_bits in ftms.FEATURE_TREADMILL_DATA_FLAGS:
+        if flags[byte_index] & flag_bits == flag_bits:
+            machine |= feature_bit
+    return ftms.FitnessMachineFeatures(machine, ftms.TARGET_SPEED_SUPPORTED)
+
+
+class FakeDevice(object):
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+        self.details = None
+
+    def __repr__(self):
+        return "FakeDevice(%s, %s)" % (self.address, self.name)
+
+
+class FakeCharacteristic(object):
+    def __init__(self, uuid, handle, properties):
+        self.uuid = uuid
+        self.handle = handle
+        self.properties = properties
+        self.description = uuid
+
+    def __repr__(self):
+        return "FakeCharacteristic(%s, %d)" % (self.uuid, self.handle)
+
+
+class FakeService(object):
+    def __init__(self, uuid, handle, characteristics):
+        self.uuid = uuid
+        self.handle = handle
+        self.characteristics = characteristics
+
+
+class FakeServiceCollection(object):
+    def __init__(self, services):
+        self.services = {service.handle: service for service in services}
+        self.characteristics = {char.handle: char for service in services for char in service.characteristics}
+
+    def __iter__(self):
+        return iter(self.services.values())
+
+    def get_characteristic(self, specifier):
+        if isinstance(specifier, int):
+            return self.characteristics.get(specifier)
+        for char in self.characteristics.values():
+            if char.uuid == str(specifier).lower():
+                return char
+        return None
+
+
+class SimulatedTreadmill(object):
+    # Speeds are in 0.01 km/h like on the wire, distance in meters and time in seconds
+
+    def __init__(self, address, name=DEVICE_NAME, rate=1.0, flags=DEFAULT_FLAGS,
+                 min_speed=50, max_speed=600, connect_delay=0.0, status_notifications=True, indications=True,
+                 response_delay=0.0, silent_status=False):
+        self.address = address
+        self.name = name
+        self.rate = rate
+        self.flags = flags
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.connect_delay = connect_delay
+        # Control point responses, commands other than Request Control need control first
+        self.indications = indications
+        # Has the status characteristics but never notifies them, like some pads
+        self.silent_status = silent_status
+        self.response_delay = response_delay
+        self.control_granted = False
+        # Number of upcoming responses which get lost
+        self.drop_responses = 0
+        self.available = True
+        self.client = None
+        self.speed = 0
+        self.resume_speed = min_speed
+        self.state = "stopped"
+        self.distance = 0.0
+        self.energy = 0.0
+        self.elapsed_time = 0.0
+        self.last_update = None
+        self.control_point_writes = []
+        self.feature_reads = 0
+        self.features = features_for_flags(flags)
+        characteristics = [
+            FakeCharacteristic(TREADMILL_DATA_UUID, 2, ["notify"]),
+            FakeCharacteristic(CONTROL_POINT_UUID, 5, ["write", "indicate"] if indications else ["write"]),
+            FakeCharacteristic(FEATURE_UUID, 7, ["read"]),
+        ]
+        if status_notifications:
+            characteristics.append(FakeCharacteristic(TRAINING_STATUS_UUID, 9, ["read", "notify"]))
+            characteristics.append(FakeCharacteristic(MACHINE_STATUS_UUID, 11, ["notify"]))
+        self.services = FakeServiceCollection([FakeService(SERVICE_UUID, 1, characteristics)])
+
+    def device(self):
+        return FakeDevice(self.address, self.name)
+
+    def advance(self, now):
+        if self.last_update is not None and self.state == "running":
+            dt = now - self.last_update
+            meters_per_second = self.speed / 360.0
+            self.distance += meters_per_second * dt
+            # About 1 kcal per kg and km for a 70 kg walker
+            self.energy += meters_per_second * dt * 0.07
+            self.elapsed_time += dt
+        self.last_update = now
+
+    def packet(self, now):
+        self.advance(now)
+        return ftms.build_treadmill_data({
+            'instantaneous_speed': self.speed,
+            'average_speed': self.speed,
+            'total_distance': int(self.distance),
+            'inclination': 0,
+            'ramp_angle': 0,
+            'elevation_gain': 0,
+            'negative_elevation_gain': 0,
+            'instantaneous_pace': 0,
+            'average_pace': 0,
+            'expended_energy': int(self.energy),
+            'energy_per_hour': 0,
+            'energy_per_minute': 0,
+            'heart_rate': 0,
+            'metabolic_equivalent': 0,
+            'elapsed_time': int(self.elapsed_time) & 0xFFFF,
+            'remaining_time': 0,
+            'force_on_belt': 0,
+            'power_output': 0,
+        }, *self.flags)
+
+    def handle_control_point(self, data, now):
+        self.advance(now)
+        self.control_point_writes.append(bytes(data))
+        opcode = data[0]
+        result = self.control_point_result(data)
+        self.respond(opcode, result)
+        if result != ftms.RESULT_SUCCESS:
+            return
+        if opcode == ftms.OP_REQUEST_CONTROL:
+            self.control_granted = True
+        elif opcode == ftms.OP_SET_TARGET_SPEED:
+            speed = int.from_bytes(data[1:3], byteorder='little')
+            speed = max(self.min_speed, min(self.max_speed, speed))
+            if self.state == "running":
+                self.speed = speed
+            self.resume_speed = speed
+            self.notify(MACHINE_STATUS_UUID, bytes([ftms.STATUS_TARGET_SPEED_CHANGED]) + speed.to_bytes(2, 'little'))
+        elif opcode == ftms.OP_START_OR_RESUME:
+            self.state = "running"
+            self.speed = self.resume_speed
+            self.notify(MACHINE_STATUS_UUID, bytes([ftms.STATUS_STARTED_OR_RESUMED]))
+            self.notify(TRAINING_STATUS_UUID, bytes([0, ftms.TRAINING_STATUS_MANUAL_MODE]))
+        elif opcode == ftms.OP_STOP_OR_PAUSE:
+            if self.speed:
+                self.resume_speed = self.speed
+            self.speed = 0
+            self.state = "paused" if data[1] == ftms.PAUSE else "stopped"
+            if data[1] == ftms.STOP:
+                self.distance = 0.0
+                self.energy = 0.0
+                self.elapsed_time = 0.0
+            self.notify(MACHINE_STATUS_UUID, bytes([ftms.STATUS_STOPPED_OR_PAUSED, data[1]]))
+            if data[1] == ftms.STOP:
+                self.notify(TRAINING_STATUS_UUID, bytes([0, ftms.TRAINING_STATUS_IDLE]))
+
+    def control_point_result(self, data):
+        opcode = data[0]
+        if opcode not in (ftms.OP_REQUEST_CONTROL, ftms.OP_SET_TARGET_SPEED, ftms.OP_START_OR_RESUME,
+                          ftms.OP_STOP_OR_PAUSE):
+            return ftms.RESULT_NOT_SUPPORTED
+        if ((opcode == ftms.OP_SET_TARGET_SPEED and len(data) < 3) or
+                (opcode == ftms.OP_STOP_OR_PAUSE and (len(data) < 2 or data[1] not in (ftms.STOP, ftms.PAUSE)))):
+            return ftms.RESULT_INVALID_PARAMETER
+        if self.indications and opcode != ftms.OP_REQUEST_CONTROL and not self.control_granted:
+            return ftms.RESULT_CONTROL_NOT_PERMITTED
+        return ftms.RESULT_SUCCESS
+
+    def respond(self, opcode, result):
+        if not self.indications:
+            return
+        if self.drop_responses:
+            self.drop_responses -= 1
+            return
+        response = ftms.build_control_point_response(opcode, result)
+        if self.response_delay:
+            asyncio.get_running_loop().call_later(self.response_delay, self.notify, CONTROL_POINT_UUID, response)
+        else:
+            self.notify(CONTROL_POINT_UUID, response)
+
+    def revoke_control(self):
+        # Another client took control
+        self.control_granted = False
+        self.notify(MACHINE_STATUS_UUID, bytes([ftms.STATUS_CONTROL_PERMISSION_LOST]))
+
+    def notify(self, uuid, data):
+        if self.silent_status and uuid in (MACHINE_STATUS_UUID, TRAINING_STATUS_UUID):
+            return
+        if self.client is not None:
+            self.client.notify(uuid, data)
+
+    def read(self, uuid):
+        if uuid == FEATURE_UUID:
+            self.feature_reads += 1
+            return self.features.to_bytes()
+        if uuid == TRAINING_STATUS_UUID:
+            return bytes([0, ftms.TRAINING_STATUS_MANUAL_MODE if self.state == "running" else ftms.TRAINING_STATUS_IDLE])
+        raise BleakError("Characteristic %s is not readable" % uuid)
+
+    def inject_disconnect(self):
+        # Drops the link as if the pad went out of range or powered down
+        if self.client is not None:
+            self.client.connection_lost()
+
+
+class FakeBleakClient(object):
+    def __init__(self, bluetooth, address_or_ble_device, disconnected_callback=None, **kwargs):
+        self.bluetooth = bluetooth
+        self.address = getattr(address_or_ble_device, 'address', address_or_ble_device)
+        self.disconnected_callback = disconnected_callback
+        self.treadmill = None
+        self.is_connected = False
+        self.notify_tasks = {}
+        self.notify_callbacks = {}
+
+    @property
+    def services(self):
+        if not self.is_connected:
+            raise BleakError("Service Discovery has not been performed yet")
+        return self.treadmill.services
+
+    async def connect(self, **kwargs):
+        treadmill = self.bluetooth.treadmills.get(self.address)
+        if treadmill is None or not treadmill.available:
+            raise BleakError("Device with address %s was not found." % self.address)
+        if treadmill.client is not None:
+            raise BleakError("Device %s is already connected" % self.address)
+        if treadmill.connect_delay:
+            await asyncio.sleep(treadmill.connect_delay)
+        treadmill.client = self
+        treadmill.control_granted = False
+        self.treadmill = treadmill
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        if self.is_connected:
+            self.connection_lost(notify=False)
+        return True
+
+    def connection_lost(self, notify=True):
+        for task in self.notify_tasks.values():
+            task.cancel()
+        self.notify_tasks = {}
+        self.notify_callbacks = {}
+        self.is_connected = False
+        self.treadmill.client = None
+        if notify and self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    def resolve(self, char_specifier):
+        if not self.is_connected:
+            raise BleakError("Not connected")
+        if isinstance(char_specifier, (int, str)):
+            char = self.treadmill.services.get_characteristic(char_specifier)
+        else:
+            char = self.treadmill.services.get_characteristic(char_specifier.handle)
+        if char is None:
+            raise BleakError("Characteristic %s was not found!" % char_specifier)
+        return char
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        char = self.resolve(char_specifier)
+        if char.handle in self.notify_tasks:
+            raise BleakError("Notifications already started for %s" % char.uuid)
+        if char.uuid == TREADMILL_DATA_UUID:
+            self.notify_tasks[char.handle] = asyncio.get_running_loop().create_task(self.emit_treadmill_data(char, callback))
+        else:
+            # Other characteristics only notify when the treadmill changes them
+            self.notify_tasks[char.handle] = asyncio.get_running_loop().create_future()
+            self.notify_callbacks[char.uuid] = (char, callback)
+
+    async def stop_notify(self, char_specifier):
+        char = self.resolve(char_specifier)
+        task = self.notify_tasks.pop(char.handle, None)
+        if task is not None:
+            task.cancel()
+        self.notify_callbacks.pop(char.uuid, None)
+
+    def notify(self, uuid, data):
+        if uuid in self.notify_callbacks:
+            char, callback = self.notify_callbacks[uuid]
+            callback(char, bytearray(data))
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        char = self.resolve(char_specifier)
+        return bytearray(self.treadmill.read(char.uuid))
+
+    async def write_gatt_char(self, char_specifier, data, response=None):
+        char = self.resolve(char_specifier)
+        if char.uuid != CONTROL_POINT_UUID:
+            raise BleakError("Characteristic %s is not writable" % char.uuid)
+        self.treadmill.handle_control_point(bytes(data), asyncio.get_running_loop().time())
+
+    async def emit_treadmill_data(self, char, callback):
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / self.treadmill.rate
+        # Notifications are scheduled against absolute deadlines so the rate doesn't drift
+        deadline = loop.time()
+        while True:
+            deadline += interval
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            callback(char, bytearray(self.treadmill.packet(loop.time())))
+
+
+class FakeBleakScanner(object):
+    def __init__(self, bluetooth, detection_callback=None, **kwargs):
+        self.bluetooth = bluetooth
+
+    def visible_devices(self):
+        return [treadmill.device() for treadmill in self.bluetooth.treadmills.values()
+                if treadmill.available and treadmill.client is None]
+
+    async def discover(self, timeout=5.0, **kwargs):
+        await asyncio.sleep(min(timeout, self.bluetooth.scan_time))
+        return self.visible_devices()
+
+    async def find_device_by_filter(self, filterfunc, timeout=10.0, **kwargs):
+        await asyncio.sleep(min(timeout, self.bluetooth.first_match_time))
+        for device in self.visible_devices():
+            if filterfunc(device, None):
+                return device
+        return None
+
+    async def find_device_by_address(self, address, timeout=10.0, **kwargs):
+        return await self.find_device_by_filter(lambda device, advertisement_data: device.address == address, timeout)
+
+
+class FakeBluetooth(object):
+    # scan_time is how long a full discover() takes, first_match_time how long it takes
+    # until the first advertisement of a device is seen
+
+    def __init__(self, scan_time=0.0, first_match_time=0.0):
+        self.scan_time = scan_time
+        self.first_match_time = first_match_time
+        self.treadmills = {}
+        self.addresses = ("02:00:00:00:%02X:%02X" % (i >> 8, i & 0xFF) for i in itertools.count(1))
+
+    def add_treadmill(self, address=None, **kwargs):
+        if address is None:
+            address = next(self.addresses)
+        treadmill = SimulatedTreadmill(address, **kwargs)
+        self.treadmills[address] = treadmill
+        return treadmill
+
+    def client(self, address_or_ble_device, disconnected_callback=None, **kwargs):
+        return FakeBleakClient(self, address_or_ble_device, disconnected_callback, **kwargs)
+
+    def scanner(self, **kwargs):
+        return FakeBleakScanner(self, **kwargs)
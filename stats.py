@@ -0,0 +1,164 @@
+import collections
+
+# Longer gaps between two samples (e.g. while disconnected) are not counted as active or
+# pause time
+DEFAULT_MAX_GAP = 10
+
+DEFAULT_WINDOWS = (("1m", 60), ("5m", 300), ("15m", 900))
+
+
+class RollingWindow(object):
+    # Time weighted mean over the last `duration` seconds. Every update appends one entry
+    # and drops the expired ones, so the cost per sample is amortized constant.
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.entries = collections.deque()
+        self.weight = 0.0
+        self.total = 0.0
+
+    def add(self, timestamp, weight, value):
+        if weight <= 0:
+            return
+        self.entries.append((timestamp, weight, value * weight))
+        self.weight += weight
+        self.total += value * weight
+        self.expire(timestamp)
+
+    def expire(self, now):
+        entries = self.entries
+        while entries and entries[0][0] <= now - self.duration:
+            _, weight, weighted_value = entries.popleft()
+            self.weight -= weight
+            self.total -= weighted_value
+        if not entries:
+            # Avoid drifting floating point sums
+            self.weight = 0.0
+            self.total = 0.0
+
+    @property
+    def mean(self):
+        if self.weight <= 0:
+            return 0.0
+        return self.total / self.weight
+
+    def clear(self):
+        self.entries.clear()
+        self.weight = 0.0
+        self.total = 0.0
+
+
+class CounterTracker(object):
+    # Turns a device counter which resets on power cycles into increments
+
+    def __init__(self):
+        self.last = None
+
+    def delta(self, value):
+        if value is None:
+            return None
+        last, self.last = self.last, value
+        if last is None:
+            return 0
+        if value < last:
+            # The counter was reset, it started from zero again
+            return value
+        return value - last
+
+    def reset(self):
+        self.last = None
+
+
+class SessionStats(object):
+    # Incremental session aggregates, fed with every decoded TreadmillSample.
+    # Speeds are reported in km/h, distances in meters, times in seconds and energy in kcal.
+
+    def __init__(self, windows=DEFAULT_WINDOWS, max_gap=DEFAULT_MAX_GAP):
+        self.max_gap = max_gap
+        self.windows = tuple((name, RollingWindow(duration)) for name, duration in windows)
+        self.distance_counter = CounterTracker()
+        self.energy_counter = CounterTracker()
+        self.reset()
+
+    def reset(self):
+        self.distance = 0.0
+        self.calories = 0.0
+        self.active_time = 0.0
+        self.pause_time = 0.0
+        self.speed_time_integral = 0.0
+        self.max_speed = 0
+        self.samples = 0
+        self.last_timestamp = None
+        self.last_speed = None
+        self.distance_counter.reset()
+        self.energy_counter.reset()
+        for _, window in self.windows:
+            window.clear()
+
+    def mark_reconnect(self):
+        # The next sample only sets new counter baselines, the gap is not accounted
+        self.last_timestamp = None
+        self.last_speed = None
+        self.distance_counter.reset()
+        self.energy_counter.reset()
+
+    def update(self, sample):
+        timestamp = sample.timestamp
+        speed = sample.instantaneous_speed
+        self.samples += 1
+
+        dt = 0.0
+        if self.last_timestamp is not None:
+            dt = timestamp - self.last_timestamp
+            if dt < 0 or dt > self.max_gap:
+                dt = 0.0
+        # The interval since the last sample is attributed to the speed reported then
+        last_speed = self.last_speed
+        if dt and last_speed is not None:
+            if last_speed > 0:
+                self.active_time += dt
+                self.speed_time_integral += last_speed * dt
+            else:
+                self.pause_time += dt
+            for _, window in self.windows:
+                window.add(timestamp, dt, last_speed)
+
+        distance = self.distance_counter.delta(sample.total_distance)
+        if distance is None:
+            # Pads without a distance counter, integrate the speed (0.01 km/h -> m/s)
+            distance = (last_speed or 0) * dt / 360.0
+        self.distance += distance
+
+        calories = self.energy_counter.delta(sample.expended_energy)
+        if calories is not None:
+            self.calories += calories
+
+        if speed > self.max_speed:
+            self.max_speed = speed
+        self.last_timestamp = timestamp
+        self.last_speed = speed
+
+    @property
+    def average_speed(self):
+        if self.active_time <= 0:
+            return 0.0
+        return self.speed_time_integral / self.active_time / 100
+
+    def window_speed(self, name):
+        for window_name, window in self.windows:
+            if window_name == name:
+                return window.mean / 100
+        raise KeyError(name)
+
+    def as_dict(self):
+        data = {
+            'session_distance': int(self.distance),
+            'session_active_time': int(self.active_time),
+            'session_pause_time': int(self.pause_time),
+            'session_average_speed': round(self.average_speed, 2),
+            'session_max_speed': self.max_speed / 100,
+            'session_calories': int(self.calories),
+        }
+        for name, window in self.windows:
+            data['speed_' + name] = round(window.mean / 100, 2)
+        return data
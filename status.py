@@ -0,0 +1,106 @@
+import time
+
+import ftms
+
+IDLE = "idle"
+RUNNING = "running"
+PAUSED = "paused"
+STOPPED = "stopped"
+STATES = (IDLE, RUNNING, PAUSED, STOPPED)
+
+
+class MachineState(object):
+    # Whether the walking pad is idle, running, paused or stopped. Transitions are driven by
+    # Fitness Machine Status and Training Status notifications. Until the pad has sent a
+    # machine status, the state is derived from the speed in the treadmill data instead.
+    #
+    # Callbacks are called with (old state, new state) on every transition.
+
+    def __init__(self):
+        self.callbacks = []
+        self.state = IDLE
+        self.since = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        # Called on every connect, the pad reports its state again
+        self.set_state(IDLE)
+        self.has_status = False
+        self.target_speed = None
+        self.training_status = None
+        self.control_lost = False
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    @property
+    def is_running(self):
+        return self.state == RUNNING
+
+    def inactive_time(self, now=None):
+        # Seconds since the pad stopped running, 0 while it runs
+        if self.state == RUNNING:
+            return 0.0
+        return (time.monotonic() if now is None else now) - self.since
+
+    def set_state(self, state):
+        if state == self.state:
+            return
+        old, self.state = self.state, state
+        self.since = time.monotonic()
+        for callback in self.callbacks:
+            callback(old, state)
+
+    def machine_status_handler(self, sender, data):
+        try:
+            opcode, parameters = ftms.parse_machine_status(data)
+        except ValueError:
+            return
+        self.has_status = True
+        if opcode == ftms.STATUS_STARTED_OR_RESUMED:
+            self.control_lost = False
+            self.set_state(RUNNING)
+        elif opcode == ftms.STATUS_STOPPED_OR_PAUSED:
+            self.set_state(PAUSED if parameters[:1] == bytes([ftms.PAUSE]) else STOPPED)
+        elif opcode == ftms.STATUS_STOPPED_BY_SAFETY_KEY:
+            self.set_state(STOPPED)
+        elif opcode == ftms.STATUS_RESET:
+            self.set_state(IDLE)
+        elif opcode == ftms.STATUS_TARGET_SPEED_CHANGED and len(parameters) >= 2:
+            self.target_speed = int.from_bytes(parameters[:2], byteorder='little')
+        elif opcode == ftms.STATUS_CONTROL_PERMISSION_LOST:
+            self.control_lost = True
+
+    def training_status_handler(self, sender, data):
+        try:
+            status, _ = ftms.parse_training_status(data)
+        except ValueError:
+            return
+        self.training_status = status
+        if status in (ftms.TRAINING_STATUS_IDLE, ftms.TRAINING_STATUS_PRE_WORKOUT):
+            self.set_state(IDLE)
+        elif status == ftms.TRAINING_STATUS_POST_WORKOUT:
+            self.set_state(STOPPED)
+        elif status == ftms.TRAINING_STATUS_OTHER:
+            # Unknown, the belt speed decides
+            return
+        elif self.state in (IDLE, STOPPED):
+            # A workout is in progress, the training status doesn't tell pauses apart
+            self.set_state(RUNNING)
+
+    def update(self, sample):
+        # Sample callback, only used until the pad sends a machine status. After that a
+        # moving belt only means running if nothing else is known, e.g. after a reconnect,
+        # the belt keeps moving for a moment after a pause.
+        speed = sample.instantaneous_speed
+        if self.has_status:
+            if speed and self.state == IDLE:
+                self.set_state(RUNNING)
+        elif speed:
+            if self.state != RUNNING:
+                self.set_state(RUNNING)
+        elif self.state == RUNNING:
+            self.set_state(PAUSED)
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import random
+import sys
+import time
+
+import metrics
+
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+WAITING = "waiting"
+CONNECTED = "connected"
+FAILED = "failed"
+
+# Errors which a reconnect can fix, e.g. the pad being out of range or the adapter being busy.
+# Everything else is a bug or a broken setup and stops the supervisor. Errors raised by bleak
+# are transient as well.
+TRANSIENT_ERRORS = (OSError, asyncio.TimeoutError, EOFError)
+
+
+def is_transient(error):
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    # bleak is imported lazily, without it no BleakError can have been raised
+    bleak_exc = sys.modules.get("bleak.exc")
+    return bleak_exc is not None and isinstance(error, bleak_exc.BleakError)
+
+
+class ConnectionSupervisor(object):
+    # Keeps a TreadmillController connected. A lost link is reconnected right away, failed
+    # attempts are retried with jittered exponential backoff up to max_backoff. Fatal errors
+    # stop the supervisor until enable() is called. With an idle_timeout the pad is
+    # disconnected once it hasn't been running for that long, and stays disconnected until
+    # enable() is called.
+    #
+    # connect_callbacks are coroutine functions awaited after every connect, state_callbacks
+    # are called with (old state, new state) and idle_callbacks after an idle disconnect.
+
+    def __init__(self, controller, logger=None, interval=1.0, initial_backoff=0.5, max_backoff=30.0, multiplier=2.0,
+                 jitter=0.5, idle_timeout=None):
+        self.controller = controller
+        self.logger = logging.getLogger("walkingpad.supervisor") if logger is None else logger
+        self.interval = interval
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.idle_timeout = idle_timeout
+        self.connect_callbacks = []
+        self.state_callbacks = []
+        self.idle_callbacks = []
+        self.state = DISCONNECTED
+        self.enabled = True
+        self.resume_on_connect = False
+        self.failures = 0
+        self.error = None
+        self.retry_at = None
+        # Monotonic time the link was lost, None while connected or before the first connect
+        self.lost_at = None
+        self.last_recovery_time = None
+        self.wakeup = None
+        self.task = None
+        controller.add_disconnect_callback(self.on_disconnect)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self.task
+
+    def wake_up(self):
+        # Only from the event loop thread, other threads use call_soon_threadsafe
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def set_state(self, state):
+        if state == self.state:
+            return
+        old, self.state = self.state, state
+        for callback in self.state_callbacks:
+            callback(old, state)
+
+    def on_disconnect(self, client):
+        if self.enabled and self.state == CONNECTED:
+            self.logger.info("Connection to the treadmill lost.")
+            self.lost_at = time.monotonic()
+            self.set_state(DISCONNECTED)
+        self.wake_up()
+
+    def backoff(self):
+        delay = min(self.max_backoff, self.initial_backoff * self.multiplier ** (self.failures - 1))
+        # Spread out retries so several clients don't hit the adapter at the same moment
+        return delay * (1 - self.jitter * random.random())
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            timeout = self.interval
+            if self.enabled and self.state != FAILED:
+                if self.controller.is_connected():
+                    if (self.idle_timeout is not None and
+                            self.controller.machine_state.inactive_time() > self.idle_timeout):
+                        await self.disconnect_idle()
+                else:
+                    if self.state == CONNECTED:
+                        # Lost without a disconnect callback
+                        self.on_disconnect(self.controller.client)
+                    if self.retry_at is None or time.monotonic() >= self.retry_at:
+                        await self.attempt()
+                    if self.state == WAITING:
+                        timeout = max(0.0, self.retry_at - time.monotonic())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def attempt(self):
+        self.set_state(CONNECTING)
+        try:
+            await self.controller.connect()
+            if self.controller.is_connected():
+                for callback in self.connect_callbacks:
+                    await callback()
+        except Exception as e:
+            if self.controller.is_connected():
+                await self.controller.client.disconnect()
+            if not is_transient(e):
+                self.fail(e)
+                return
+            self.logger.info("Connecting failed: " + str(e))
+        if not self.controller.is_connected():
+            self.failures += 1
+            delay = self.backoff()
+            self.retry_at = time.monotonic() + delay
+            self.logger.info("Retrying in %.1fs (attempt %d)" % (delay, self.failures))
+            self.set_state(WAITING)
+            return
+        if self.lost_at is not None:
+            self.last_recovery_time = time.monotonic() - self.lost_at
+            metrics.RECOVERY_TIME.observe(self.last_recovery_time)
+            self.logger.info("Recovered after %.1fs" % self.last_recovery_time)
+        self.lost_at = None
+        self.failures = 0
+        self.retry_at = None
+        self.set_state(CONNECTED)
+        if self.resume_on_connect:
+            self.resume_on_connect = False
+            try:
+                await self.controller.scheduler.resume()
+            except Exception as e:
+                self.logger.error("Failed to resume: " + str(e))
+
+    def fail(self, error):
+        self.logger.error("Giving up on the treadmill connection", exc_info=error)
+        metrics.FATAL_ERRORS.inc()
+        self.error = error
+        self.retry_at = None
+        self.set_state(FAILED)
+
+    def enable(self, resume=False):
+        # Reconnects after disconnect(), an idle timeout or a fatal error, and retries
+        # right away while waiting for the next attempt
+        self.enabled = True
+        self.error = None
+        self.failures = 0
+        self.retry_at = None
+        self.resume_on_connect = resume
+        if self.state == FAILED:
+            self.set_state(DISCONNECTED)
+        self.wake_up()
+
+    async def disconnect(self):
+        self.enabled = False
+        self.lost_at = None
+        self.retry_at = None
+        if self.controller.is_connected():
+            await self.controller.client.disconnect()
+        self.set_state(DISCONNECTED)
+        self.wake_up()
+
+    async def disconnect_idle(self):
+        await self.disconnect()
+        self.logger.info("Disconnected from treadmill due to inactivity.")
+        for callback in self.idle_callbacks:
+            callback()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.disconnect()
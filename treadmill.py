@@ -1,332 +1,354 @@
+import activity
 import asyncio
-import bleak
-import struct
+import daemon
+import export
+import ftms
+import metrics
+import recorder
+import stats
+import status
+import os
 import time
+import string
+import supervisor
 import threading
-from bleak import BleakClient
+import workout
+from controller import TreadmillController
 from i3pystatus import IntervalModule, formatp
 from i3pystatus.core.color import ColorRangeModule
 
 
-class TreadmillDataClient(object):
-    def __init__(self, client, treadmill_data_characteristic):
-        self.treadmill_data_characteristic = treadmill_data_characteristic
-        self.client = client
-        self.data = {}
-         
-    async def read(self):
-        await self.client.start_notify(self.treadmill_data_characteristic, lambda sender, data: self.treadmill_data_handler(sender, data))
-        await asyncio.sleep(2)
-        await self.client.stop_notify(self.treadmill_data_characteristic)
-        return self.data
-
-    def treadmill_data_handler(self, sender, data):
-        parsed_data = self.parse_treadmill_data(data)
-        self.data = parsed_data 
-
-    def parse_uint8(self, byte_array):
-        return struct.unpack('B', bytes(byte_array[:1]))[0], byte_array[1:]
-
-    def parse_uint16(self, byte_array):
-        return struct.unpack('H', bytes(byte_array[:2]))[0], byte_array[2:]
-
-    def parse_sint16(self, byte_array):
-        return struct.unpack('h', bytes(byte_array[:2]))[0], byte_array[2:]
-
-    def parse_treadmill_data(self, byte_array):
-        # Ensure we have at least two bytes for the flags
-        if len(byte_array) < 2:
-            raise ValueError("Input byte array is too short to contain valid flags")
-
-        # Extract the two flag bytes
-        flags_byte1 = byte_array[0]
-        flags_byte2 = byte_array[1]
-        byte_array = byte_array[2:]
-        
-        # Create a dictionary to store the parsed data
-        data = {}
-
-        # Mandatory fields        
-        speed, byte_array = self.parse_uint16(byte_array)
-        data['instantaneous_speed'] = speed
-
-        # Check flags and parse data accordingly (byte 1)
-
-        # Average Speed (bit 1)
-        if flags_byte1 & 0x02:
-            speed, byte_array = self.parse_uint16(byte_array)
-            data['average_speed'] = speed
-        
-        # Total Distance (bit 2)
-        if flags_byte1 & 0x04:
-            distance_bytes = byte_array[:3] + bytearray([0x00]) # Add 4th byte because the distance is 24 bit
-            distance = struct.unpack('I', bytes(distance_bytes))[0]
-            byte_array = byte_array[3:]
-            data['total_distance'] = distance
-        
-        # Inclination and Ramp Angle Setting (bit 3)
-        if flags_byte1 & 0x08:
-            incline, byte_array = self.parse_sint16(byte_array)
-            ramp_angle, byte_array = self.parse_sint16(byte_array)
-            data['inclination'] = incline
-            data['ramp_angle'] = ramp_angle
-        
-        # Elevation Gain (bit 4)
-        if flags_byte1 & 0x10:
-            elevation_gain, byte_array= self.parse_uint16(byte_array)
-            negative_elevation_gain, byte_array = self.parse_uint16(byte_array)
-            data['elevation_gain'] = elevation_gain
-            data['negative_elevation_gain'] = negative_elevation_gain
-
-        # Instantaneous Pace (bit 5)
-        if flags_byte1 & 0x20:
-            pace, byte_array = self.parse_uint8(byte_array)
-            data['instantaneous_pace'] = pace
-
-        # Average Pace (bit 6)
-        if flags_byte1 & 0x40:
-            avg_pace, byte_array = self.parse_uint8(byte_array)
-            data['average_pace'] = avg_pace
-        
-        # Expended Energy (bit 7)
-        if flags_byte1 & 0x80:
-            total_energy, byte_array = self.parse_uint16(byte_array)
-            energy_per_hour, byte_array = self.parse_uint16(byte_array)
-            energy_per_minute, byte_array = self.parse_uint8(byte_array)
-            data['expended_energy'] = total_energy
-            data['energy_per_hour'] = energy_per_hour
-            data['energy_per_minute'] = energy_per_minute
-
-        # Check flags and parse data accordingly (byte 2)
-        # Heart Rate (bit 0)
-        if flags_byte2 & 0x01:
-            heart_rate, byte_array = self.parse_uint8(byte_array)
-            data['heart_rate'] = heart_rate
-
-        # Metabolic Equivalent (bit 1)
-        if flags_byte2 & 0x02:
-            met_eq, byte_array= self.parse_uint8(byte_array)
-            data['metabolic_equivalent'] = met_eq
-        
-        # Elapsed Time (bit 2)
-        if flags_byte2 & 0x04:
-            elapsed_time, byte_array = self.parse_uint16(byte_array) 
-            data['elapsed_time'] = elapsed_time
-        
-        # Remaining Time (bit 3)
-        if flags_byte2 & 0x08:
-            remaining_time, byte_array = self.parse_uint16(byte_array)
-            data['remaining_time'] = remaining_time
-        
-        # Force on Belt and Power Output (bit 4)
-        if flags_byte2 & 0x10:
-            force,byte_array = self.parse_sint16(byte_array)
-            power_output,byte_array = self.parse_sint16(byte_array)
-            data['force_on_belt'] = force
-            data['power_output'] = power_output
-
-        return data
-
-class FitnessMachineControlPoint(object):
-    def __init__(self, client, machine_control_point_characteristic):
-        self.machine_control_point_characteristic = machine_control_point_characteristic
-        self.client = client
-            
-    async def send_resume_command(self):
-        await self.client.write_gatt_char(self.machine_control_point_characteristic, bytearray([0x07]), response=False)
-
-    async def send_pause_command(self):
-        await self.client.write_gatt_char(self.machine_control_point_characteristic, bytearray([0x08, 0x02]), response=False)
-
-    async def send_stop_command(self):
-        await self.client.write_gatt_char(self.machine_control_point_characteristic, bytearray([0x08, 0x01]), response=False)
-
-    async def set_speed(self, speed):
-        speed_bytes = speed.to_bytes(2, byteorder='little')
-        await self.client.write_gatt_char(self.machine_control_point_characteristic, bytearray([0x02, speed_bytes[0], speed_bytes[1]]), response=False)
-
-class TreadmillController(object):
-    control_point = None
-    treadmill_data_client = None
-    logger = None 
-    client = None
-
-    def __init__(self, logger):
-        self.logger = logger 
-
-    async def connect(self):
-        DEVICE_NAME = "EsangLinker"
-        scanner = bleak.BleakScanner()
-        devices = await scanner.discover()
-        walking_pad = None
-        for device in devices:
-            if(device.name == DEVICE_NAME):
-                walking_pad = device
-                self.logger.debug("Found walking pad: " + walking_pad.address + " " + walking_pad.name)
-                break
-        if(walking_pad is None):
-            self.logger.error("Walking pad not found")
-            return None
-        self.client = BleakClient(walking_pad.address)
-        await self.client.connect()
-        self.logger.info("Connected to " + walking_pad.address)
-        try: 
-            characteristics = await self.get_all_characteristics()
-            control_point_characteristic = self.get_fitness_machine_control_point_characteristic(characteristics)
-            treadmill_data_characteristic = self.get_treadmill_data_characteristic(characteristics)
-            self.control_point = FitnessMachineControlPoint(self.client, control_point_characteristic)
-            self.treadmill_data_client = TreadmillDataClient(self.client, treadmill_data_characteristic)
-
-        except Exception as e:
-            self.logger.exception("Failed to connect.")
-            await self.client.disconnect()
-            return
-
-
-    async def get_all_characteristics(self):
-        if(self.client is None):
-            self.logger.error("Client not connected")
-            return []   
-        characteristics = []
-        for service in self.client.services:
-            for char in service.characteristics:
-                characteristics.append(char)
-        return characteristics
-
-    def get_fitness_machine_control_point_characteristic(self, characteristics):
-        for char in characteristics:
-            if not char:
-                continue    
-            if char.uuid[:8] == "00002ad9":
-                return char
-        self.logger.error("Fitness Machine Control Point characteristic not found")
-        return None
-        
-    def get_treadmill_data_characteristic(self, characteristics):
-        for char in characteristics:
-            if not char:
-                continue    
-            if char.uuid[:8] == "00002acd":
-                return char
-        self.logger.error("Treadmill Data characteristic not found")
-        return None
- 
 class Treadmill(IntervalModule, ColorRangeModule):
     settings = (
         ("format", "format string"),
+        ("address", "bluetooth address of the walking pad, skips scanning"),
+        ("record_path", "append raw treadmill data to this session file"),
+        ("metrics_port", "serve metrics in the Prometheus text format on this local port"),
+        ("export_path", "write every workout as TCX, FIT and CSV files to this directory"),
+        ("export_formats", "list of export formats, any of tcx, fit and csv"),
+        ("history_path", "keep the walking history in this SQLite database"),
+        ("workout_path", "interval workout program, started and stopped with a middle click"),
+        ("paused_interval", "seconds between updates while the belt is not running"),
+        ("idle_unsubscribe_timeout", "stop the treadmill data notifications after the belt hasn't been running "
+                                     "for this many seconds, if the pad reports its state"),
+        ("socket_path", "get data from the walkingpad daemon on this socket instead of connecting directly"),
     )
     format = "{instantaneous_speed}km/h {total_distance}m"
     controller = None
     data = {}
+    sample = None
     output = {}
     event_loop = None
     interval = 1
     on_leftclick = "pause_resume"
     on_rightclick = "close"
+    on_middleclick = "toggle_workout"
     on_upscroll = "increment_speed"
     on_downscroll = "decrement_speed"
     pause_disconnect_timeout = 300
-    pause_start = None
-    is_inactive = False
-    task_queue = []
+    paused_interval = 5
+    idle_unsubscribe_timeout = 60
+    activity = None
+    record_path = None
+    address = None
+    metrics_port = None
+    export_path = None
+    export_formats = export.FORMATS
+    exporter = None
+    history_path = None
+    history_store = None
+    workout_path = None
+    workout_engine = None
+    socket_path = None
+    daemon_client = None
+    daemon_connected = False
+    stats = None
+    machine_state = None
+    state_format = False
+    supervisor = None
+    target_speed = None
+    target_speed_time = None
+    target_speed_timeout = 3
     thread = None
-
-    def update_thread(self):
-        self.logger.info("Starting update thread")
-        while True:
-            self.logger.debug("Entering run " + str(self.pause_start))
-            if not self.is_inactive and (self.controller.client is None or not self.controller.client.is_connected):
-                self.pause_start = None
-                self.event_loop.run_until_complete(self.controller.connect())
-
-            if self.controller.client is None or not self.controller.client.is_connected:
-                format_str = "Treadmill not connected."
-                self.data = {}
-            else:
-                try:
-                    while len(self.task_queue) > 0:
-                        task = self.task_queue.pop(0)
-                        self.logger.info("Executing scheduled task.")
-                        self.event_loop.run_until_complete(task)
-                    self.data = self.event_loop.run_until_complete(self.controller.treadmill_data_client.read())
-                    if self.data["instantaneous_speed"] == 0:
-                        if self.pause_start is None:
-                            self.pause_start = time.time()
-                            self.logger.info("Starting paused timeout.")
-                        elif time.time() - self.pause_start > self.pause_disconnect_timeout:
-                            self.event_loop.run_until_complete(self.controller.client.disconnect())
-                            self.is_inactive = True
-                            self.logger.info("Disconnected from treadmill due to inactivity.")
-                    else:
-                        self.pause_start = None
-
-                    format_str = self.format
-
-                    data = self.data.copy()
-                    # Convert speed to km/h
-                    data["instantaneous_speed"] = data["instantaneous_speed"] / 100
-                    self.output = {
-                        "full_text": formatp(format_str, **data).strip(),
-                        'color': "E7BA3C"
-                    }
-                except Exception as e:
-                    self.logger.error("Error in update_thread" + str(e))
-                    self.data = {}
-                    format_str = "Error reading treadmill data."
-                    self.output = {
-                        "full_text": format_str,
-                        'color': "FF0000"
-                    }
-                    break
-            time.sleep(self.interval)
-        self.controller.treadmill.close()
-        self.logger.debug("Exiting run")
-
+    format_fields = ()
+    plain_format = False
+    render_key = None
 
     def init(self):
+        self.compile_format()
+        if self.metrics_port:
+            metrics.start_http_server(self.metrics_port)
         self.event_loop = asyncio.new_event_loop()
-        self.controller = TreadmillController(self.logger)
-        self.thread = threading.Thread(target=self.update_thread, daemon=True)
+        # One event loop runs forever in this thread, everything else is submitted to it
+        self.thread = threading.Thread(target=self.event_loop.run_forever, daemon=True)
         self.thread.start()
+        if self.socket_path:
+            # The daemon owns the connection, samples and commands go through its socket
+            self.stats = stats.SessionStats()
+            self.machine_state = status.MachineState()
+            self.machine_state.add_callback(self.on_state_change)
+            self.submit(self.daemon_loop())
+            return
+        session_recorder = recorder.SessionRecorder(self.record_path) if self.record_path else None
+        self.controller = TreadmillController(self.logger, recorder=session_recorder, address=self.address)
+        self.stats = self.controller.stats
+        self.machine_state = self.controller.machine_state
+        self.machine_state.add_callback(self.on_state_change)
+        # Rendering is throttled while the belt is not running
+        self.activity = activity.ActivityPolicy(self.controller, self.paused_interval, self.idle_unsubscribe_timeout,
+                                                logger=self.logger)
+        self.activity.add_sample_callback(self.on_sample)
+        if self.export_path:
+            self.exporter = export.WorkoutExporter(self.export_path, self.export_formats, logger=self.logger)
+            self.exporter.attach(self.controller)
+        if self.history_path:
+            import historydb
+            self.history_store = historydb.HistoryStore(self.history_path, logger=self.logger)
+            self.history_store.attach(self.controller)
+        self.supervisor = supervisor.ConnectionSupervisor(self.controller, self.logger, interval=self.interval,
+                                                          idle_timeout=self.pause_disconnect_timeout)
+        self.supervisor.connect_callbacks.append(self.activity.on_connect)
+        self.supervisor.state_callbacks.append(self.on_connection_state)
+        self.supervisor.idle_callbacks.append(self.on_idle)
+        self.set_disconnected("Treadmill not connected.", "E7BA3C")
+        self.event_loop.call_soon_threadsafe(self.supervisor.start)
 
     def run(self):
         pass
-    
+
+    def compile_format(self):
+        # Finds the fields the format references, output is only re-rendered if one of them changes
+        fields = []
+        for _, field_name, _, _ in string.Formatter().parse(self.format):
+            if field_name:
+                name = field_name.split(".")[0].split("[")[0]
+                if name not in fields:
+                    fields.append(name)
+        self.format_fields = tuple(fields)
+        stats_fields = set(stats.SessionStats().as_dict())
+        self.sample_format_fields = tuple(name for name in fields if name not in stats_fields and name != "state")
+        self.stats_format_fields = tuple(name for name in fields if name in stats_fields)
+        self.state_format = "state" in fields
+        self.render_fields = self.sample_format_fields + self.stats_format_fields + (("state",) if self.state_format else ())
+        # Without groups formatp is equivalent to str.format, which is much cheaper
+        self.plain_format = "[" not in self.format and "]" not in self.format
+        self.render_key = None
+
+    def set_output(self, full_text, color):
+        if self.output.get("full_text") != full_text or self.output.get("color") != color:
+            self.output = {
+                "full_text": full_text,
+                'color': color
+            }
+
+    def submit(self, coroutine):
+        # Thread safe, returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coroutine, self.event_loop)
+
+    def is_connected(self):
+        if self.socket_path:
+            return self.daemon_connected
+        return self.controller.is_connected()
+
+    def set_disconnected(self, full_text, color):
+        self.data = {}
+        self.sample = None
+        self.render_key = None
+        self.set_output(full_text, color)
+
+    async def daemon_loop(self):
+        self.logger.info("Using daemon at " + self.socket_path)
+        while True:
+            client = daemon.DaemonClient(self.socket_path)
+            try:
+                await client.connect()
+            except OSError as e:
+                self.logger.debug("Daemon not reachable: " + str(e))
+                self.daemon_connected = False
+                self.set_disconnected("Treadmill daemon not running.", "E7BA3C")
+                await asyncio.sleep(self.interval)
+                continue
+            # Commands only go through a connected client
+            self.daemon_client = client
+            try:
+                async for message in client.messages():
+                    try:
+                        self.handle_daemon_message(message)
+                    except Exception as e:
+                        # Nothing checks the result of this task, a failure must not end it
+                        self.logger.exception("Failed to handle daemon message: " + str(e))
+            finally:
+                self.daemon_client = None
+                await client.close()
+            self.daemon_connected = False
+            self.set_disconnected("Treadmill daemon not running.", "E7BA3C")
+
+    def handle_daemon_message(self, message):
+        if message["type"] == "status":
+            was_connected, self.daemon_connected = self.daemon_connected, message["connected"]
+            self.machine_state.set_state(message.get("state", status.IDLE))
+            if self.daemon_connected:
+                # Status messages are also sent on every state and mode change, only a new
+                # connection breaks the sample deltas
+                if not was_connected:
+                    self.stats.mark_reconnect()
+            else:
+                self.set_disconnected("Treadmill not connected.", "E7BA3C")
+        elif message["type"] == "sample":
+            sample = ftms.TreadmillSample(message["timestamp"], **message["data"])
+            self.stats.update(sample)
+            self.on_sample(sample)
+
+    def on_connection_state(self, old, new):
+        if new == supervisor.FAILED:
+            self.set_disconnected("Error reading treadmill data.", "FF0000")
+        elif new != supervisor.CONNECTED:
+            self.set_disconnected("Treadmill not connected.", "E7BA3C")
+
+    def on_idle(self):
+        if self.exporter is not None:
+            self.exporter.finish()
+
+    def on_state_change(self, old, new):
+        self.logger.info("Treadmill " + new)
+        if self.state_format and self.sample is not None:
+            self.on_sample(self.sample)
+
+    def on_sample(self, sample):
+        try:
+            self.render_sample(sample)
+        except Exception as e:
+            self.logger.error("Error handling treadmill data " + str(e))
+            self.render_key = None
+            self.set_output("Error reading treadmill data.", "FF0000")
+
+    def render_sample(self, sample):
+        self.sample = sample
+        if self.target_speed is not None and (sample.instantaneous_speed == self.target_speed or
+                                              time.time() - self.target_speed_time > self.target_speed_timeout):
+            self.target_speed = None
+
+        # Only the referenced fields are looked at, unchanged values keep the current output
+        values = tuple(getattr(sample, name, None) for name in self.sample_format_fields)
+        if self.stats_format_fields:
+            stats_data = self.stats.as_dict()
+            values += tuple(stats_data[name] for name in self.stats_format_fields)
+        if self.state_format:
+            values += (self.machine_state.state,)
+        if values == self.render_key:
+            return
+        self.render_key = values
+
+        data = {}
+        for name, value in zip(self.render_fields, values):
+            if value is not None:
+                data[name] = value
+        if "instantaneous_speed" in data:
+            # Convert speed to km/h
+            data["instantaneous_speed"] = data["instantaneous_speed"] / 100
+        self.data = data
+        if self.plain_format:
+            full_text = self.format.format(**data).strip()
+        else:
+            full_text = formatp(self.format, **data).strip()
+        self.set_output(full_text, "E7BA3C")
+
+    def current_speed(self):
+        if self.sample is None:
+            return None
+        return self.sample.instantaneous_speed
+
+    async def execute(self, command, *args):
+        if self.socket_path:
+            if self.daemon_client is None:
+                return
+            reply = await self.daemon_client.command(command, *args)
+            return reply.get("wait")
+        if not self.is_connected() or self.controller.control_point is None:
+            self.logger.info("Treadmill not connected, dropping " + command)
+            return
+        self.logger.info("Scheduling " + command)
+        result = await self.controller.scheduler.submit(command, *args)
+        self.logger.debug("Sent " + command + ": " + repr(result))
+        return result.wait
+
     def pause_resume(self):
         self.logger.info("Pause/Resume")
-        if self.is_inactive:
-            self.logger.info("Reconnecting")
-            self.is_inactive = False
-            self.task_queue.append(self.event_loop.create_task(self.controller.control_point.send_resume_command()))
+        if self.socket_path and not self.daemon_connected:
+            # The daemon reconnects and resumes
+            self.submit(self.execute("send_resume_command"))
             return
-
-        if "instantaneous_speed" not in self.data:
-            self.logger.info("Failed to resume.")
+        if not self.is_connected():
+            # Reconnects right away, also after an idle timeout or an error
+            self.logger.info("Reconnecting")
+            self.event_loop.call_soon_threadsafe(self.supervisor.enable, True)
             return
 
-        if self.data["instantaneous_speed"] == 0:
-            self.task_queue.append(self.event_loop.create_task(self.controller.control_point.send_resume_command()))
-            self.logger.info("Created resume task")
-        else: 
-            self.task_queue.append(self.event_loop.create_task(self.controller.control_point.send_pause_command()))
-            self.logger.info("Created pause task")
-        self.logger.info("Returning from pause_resume")
+        if self.machine_state.is_running:
+            self.submit(self.execute("send_pause_command"))
+            self.logger.info("Submitted pause command")
+        else:
+            self.submit(self.execute("send_resume_command"))
+            self.logger.info("Submitted resume command")
+
+    def change_speed(self, delta):
+        # Scroll events are relative to the last requested speed until the pad reports it,
+        # the scheduler merges them into a single write
+        if self.target_speed is not None:
+            current_speed = self.target_speed
+        else:
+            current_speed = self.current_speed()
+        if current_speed is None:
+            return False
+        self.target_speed = max(0, current_speed + delta)
+        self.target_speed_time = time.time()
+        self.submit(self.execute("set_speed", self.target_speed))
+        return True
 
     def increment_speed(self):
-        if "instantaneous_speed" not in self.data:
+        if not self.change_speed(10):
             self.logger.info("Failed to increment speed.")
-            return
-        new_speed = self.data["instantaneous_speed"] + 10
-        self.task_queue.append(self.event_loop.create_task(self.controller.control_point.set_speed(new_speed)))
-        self.data["instantaneous_speed"] = new_speed
 
     def decrement_speed(self):
-        if "instantaneous_speed" not in self.data:
+        if not self.change_speed(-10):
             self.logger.info("Failed to decrement speed.")
+
+    def toggle_workout(self):
+        if self.socket_path:
+            self.submit(self.toggle_daemon_workout())
+            return
+        engine = self.workout_engine
+        # The task is created on the loop thread, until then the engine counts as running.
+        # The cancel is queued behind start_task, so it still stops it.
+        if engine is not None and (engine.task is None or not engine.task.done()):
+            self.logger.info("Stopping workout")
+            self.submit(engine.cancel())
+            self.workout_engine = None
+            return
+        if not self.workout_path:
+            self.logger.info("No workout configured.")
+            return
+        try:
+            program = workout.load_program(self.workout_path)
+        except (OSError, ValueError) as e:
+            self.logger.error("Failed to load workout " + self.workout_path + ": " + str(e))
             return
-        new_speed = self.data["instantaneous_speed"] - 10
-        self.event_loop.create_task(self.controller.control_point.set_speed(new_speed))
-        self.data["instantaneous_speed"] = new_speed
+        self.workout_engine = workout.WorkoutEngine(self.controller, program, logger=self.logger)
+        self.event_loop.call_soon_threadsafe(self.workout_engine.start_task)
+
+    async def toggle_daemon_workout(self):
+        if self.daemon_client is None:
+            return
+        reply = await self.daemon_client.command("status")
+        if reply.get("workout") is not None:
+            await self.daemon_client.command("stop_workout")
+        elif self.workout_path:
+            await self.daemon_client.command("start_workout", os.path.abspath(self.workout_path))
 
     def close(self):
-        self.event_loop.create_task(self.controller.client.disconnect())
+        if self.socket_path:
+            self.submit(self.execute("disconnect"))
+            return
+        self.submit(self.supervisor.disconnect())
+        if self.exporter is not None:
+            self.exporter.finish()
@@ -0,0 +1,330 @@
+import asyncio
+import bisect
+import json
+import logging
+
+import status
+
+# Interval workouts. A program is a JSON file with a list of steps, speeds are in km/h and
+# durations in seconds. Steps can be repeated in blocks:
+#
+#   {"name": "Intervals", "steps": [
+#       {"speed": 3.0, "duration": 300},
+#       {"repeat": 10, "steps": [{"speed": 5.0, "duration": 120}, {"speed": 3.0, "duration": 60}]},
+#       {"pause": true, "duration": 60},
+#       {"stop": true}
+#   ]}
+
+SPEED = "speed"
+PAUSE = "pause"
+STOP = "stop"
+
+
+class WorkoutStep(object):
+    __slots__ = ('action', 'speed', 'duration')
+
+    def __init__(self, action, speed=None, duration=0.0):
+        self.action = action
+        # 0.01 km/h like on the wire
+        self.speed = speed
+        self.duration = duration
+
+    def __eq__(self, other):
+        if not isinstance(other, WorkoutStep):
+            return NotImplemented
+        return (self.action, self.speed, self.duration) == (other.action, other.speed, other.duration)
+
+    def __repr__(self):
+        if self.action == SPEED:
+            return "WorkoutStep(%.2fkm/h, %ss)" % (self.speed / 100, self.duration)
+        return "WorkoutStep(%s, %ss)" % (self.action, self.duration)
+
+
+class WorkoutProgram(object):
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = tuple(steps)
+        # End of every step in seconds from the start of the program
+        self.ends = []
+        end = 0.0
+        for step in self.steps:
+            end += step.duration
+            self.ends.append(end)
+        self.duration = end
+
+    def __len__(self):
+        return len(self.steps)
+
+    def step_at(self, elapsed):
+        # Index of the step running `elapsed` seconds into the program
+        return bisect.bisect_right(self.ends, elapsed)
+
+
+def parse_steps(entries, depth=0):
+    if not isinstance(entries, list):
+        raise ValueError("Workout steps must be a list")
+    steps = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise ValueError("Invalid workout step " + repr(entry))
+        if "repeat" in entry:
+            if depth > 4:
+                raise ValueError("Workout blocks are nested too deep")
+            block = parse_steps(entry.get("steps"), depth + 1)
+            steps.extend(block * int(entry["repeat"]))
+            continue
+        duration = float(entry.get("duration", 0))
+        if duration < 0:
+            raise ValueError("Negative duration in workout step " + repr(entry))
+        if entry.get("stop"):
+            steps.append(WorkoutStep(STOP))
+        elif entry.get("pause"):
+            steps.append(WorkoutStep(PAUSE, duration=duration))
+        elif "speed" in entry:
+            speed = int(round(float(entry["speed"]) * 100))
+            if speed <= 0:
+                raise ValueError("Speed must be positive in workout step " + repr(entry))
+            steps.append(WorkoutStep(SPEED, speed, duration))
+        else:
+            raise ValueError("Workout step needs a speed, pause or stop " + repr(entry))
+    return steps
+
+
+def parse_program(content, name=None):
+    if isinstance(content, list):
+        content = {"steps": content}
+    if not isinstance(content, dict):
+        raise ValueError("Invalid workout program")
+    steps = parse_steps(content.get("steps"))
+    if not steps:
+        raise ValueError("Workout program has no steps")
+    return WorkoutProgram(content.get("name", name or "Workout"), steps)
+
+
+def load_program(path):
+    with open(path) as f:
+        content = json.load(f)
+    return parse_program(content, path)
+
+
+class WorkoutEngine(object):
+    # Runs a WorkoutProgram on a TreadmillController. Step boundaries are absolute deadlines
+    # on the event loop clock relative to the start of the program, so late wakeups don't
+    # add up. The program clock is suspended while the pad is disconnected or paused by the
+    # user, afterwards the current step is applied again with its remaining time. A lost
+    # link suspends it right away, the pad may have stopped the belt even if it is back
+    # before the step ends.
+    #
+    # Every step is confirmed against the reported instantaneous speed, unconfirmed steps
+    # are sent again up to `retries` times.
+
+    def __init__(self, controller, program, confirm_timeout=5.0, retries=2, speed_tolerance=10,
+                 poll_interval=1.0, logger=None):
+        self.controller = controller
+        self.program = program
+        self.confirm_timeout = confirm_timeout
+        self.retries = retries
+        self.speed_tolerance = speed_tolerance
+        self.poll_interval = poll_interval
+        self.logger = logging.getLogger("walkingpad.workout") if logger is None else logger
+        self.callbacks = []
+        self.index = 0
+        # Program time, the loop time at which the program would have started without suspensions
+        self.start = None
+        self.suspended_at = 0.0
+        self.suspended = True
+        self.user_paused = False
+        self.applied = None
+        self.confirm_speed = None
+        self.confirm_deadline = None
+        self.confirm_attempts = 0
+        self.applied_at = None
+        self.last_sample = None
+        self.confirm_times = []
+        self.unconfirmed = []
+        self.finished = False
+        self.wakeup = None
+        self.loop = None
+        self.task = None
+
+    def add_callback(self, callback):
+        # Called with (index, step) when a step starts, and with (None, None) at the end
+        self.callbacks.append(callback)
+
+    @property
+    def current_step(self):
+        if self.index >= len(self.program):
+            return None
+        return self.program.steps[self.index]
+
+    def elapsed(self):
+        if self.suspended:
+            return self.suspended_at
+        return self.loop.time() - self.start
+
+    def remaining(self):
+        # Seconds left in the current step
+        if self.index >= len(self.program):
+            return 0.0
+        return max(0.0, self.program.ends[self.index] - self.elapsed())
+
+    def start_task(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self.task
+
+    async def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def is_active(self):
+        return self.controller.is_connected() and not self.user_paused
+
+    def on_sample(self, sample):
+        self.last_sample = self.loop.time()
+        if self.confirm_speed is not None and abs(sample.instantaneous_speed - self.confirm_speed) <= self.speed_tolerance:
+            self.confirm_times.append(self.last_sample - self.applied_at)
+            self.confirm_speed = None
+            self.confirm_deadline = None
+        if self.suspended and self.wakeup is not None:
+            self.wakeup.set()
+
+    def on_disconnect(self, client):
+        self.suspend(self.loop)
+        self.wakeup.set()
+
+    def on_state_change(self, old, new):
+        step = self.current_step
+        if step is None or self.applied != self.index:
+            return
+        if new in (status.PAUSED, status.STOPPED) and step.action == SPEED:
+            self.logger.info("Workout paused by the user")
+            self.user_paused = True
+        elif new == status.RUNNING and self.user_paused:
+            self.logger.info("Workout resumed by the user")
+            self.user_paused = False
+        else:
+            return
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self):
+        loop = self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.controller.add_sample_callback(self.on_sample)
+        self.controller.machine_state.add_callback(self.on_state_change)
+        self.controller.add_disconnect_callback(self.on_disconnect)
+        self.logger.info("Starting workout " + self.program.name)
+        try:
+            while self.index < len(self.program):
+                if not self.is_active():
+                    self.suspend(loop)
+                    await self.wait(self.poll_interval)
+                    continue
+                if self.suspended:
+                    # The remaining time of the current step is kept
+                    self.suspended = False
+                    self.start = loop.time() - self.suspended_at
+                    self.applied = None
+                index = self.index
+                if self.program.steps[index].action != STOP:
+                    index = self.program.step_at(loop.time() - self.start)
+                if index != self.index:
+                    # A stop is never skipped, even though it takes no time
+                    for skipped in range(self.index + 1, index):
+                        if self.program.steps[skipped].action == STOP:
+                            index = skipped
+                            break
+                    self.index = index
+                    continue
+                step = self.program.steps[index]
+                if self.applied != index:
+                    self.notify_step(index, step)
+                    self.applied = index
+                    await self.apply(step)
+                    if step.action == STOP:
+                        break
+                elif self.confirm_deadline is not None and loop.time() >= self.confirm_deadline:
+                    await self.retry(step)
+                deadline = self.start + self.program.ends[index]
+                if self.confirm_deadline is not None:
+                    deadline = min(deadline, self.confirm_deadline)
+                await self.wait(deadline - loop.time())
+            self.finished = True
+            self.logger.info("Finished workout " + self.program.name)
+            self.notify_step(None, None)
+        finally:
+            self.controller.remove_sample_callback(self.on_sample)
+            self.controller.machine_state.remove_callback(self.on_state_change)
+            self.controller.remove_disconnect_callback(self.on_disconnect)
+
+    def suspend(self, loop):
+        if self.suspended:
+            return
+        # The connection may have been lost a while before it was noticed, the program
+        # continues from the last sample
+        now = loop.time()
+        if self.last_sample is not None and self.last_sample > self.start:
+            now = min(now, self.last_sample)
+        self.suspended_at = now - self.start
+        self.suspended = True
+        self.confirm_speed = None
+        self.confirm_deadline = None
+        self.logger.info("Workout suspended at %.1fs in step %d" % (self.suspended_at, self.index))
+
+    async def wait(self, timeout):
+        if timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+
+    def notify_step(self, index, step):
+        if step is not None:
+            self.logger.info("Workout step %d/%d: %r" % (index + 1, len(self.program), step))
+        for callback in self.callbacks:
+            callback(index, step)
+
+    async def apply(self, step):
+        self.confirm_attempts = 0
+        await self.send(step)
+
+    async def retry(self, step):
+        if self.confirm_attempts > self.retries:
+            self.logger.warning("Workout step %d was not confirmed by the treadmill" % self.index)
+            self.unconfirmed.append(self.index)
+            self.confirm_speed = None
+            self.confirm_deadline = None
+            return
+        self.logger.info("Workout step %d not confirmed yet, sending it again" % self.index)
+        await self.send(step)
+
+    async def send(self, step):
+        loop = asyncio.get_running_loop()
+        scheduler = self.controller.scheduler
+        self.confirm_attempts += 1
+        self.applied_at = loop.time()
+        self.confirm_deadline = self.applied_at + self.confirm_timeout
+        try:
+            if step.action == SPEED:
+                self.confirm_speed = step.speed
+                if self.controller.machine_state.is_running:
+                    await scheduler.set_speed(step.speed)
+                else:
+                    # The resume is written first, the speed change right after it
+                    await asyncio.gather(scheduler.resume(), scheduler.set_speed(step.speed))
+            elif step.action == PAUSE:
+                self.confirm_speed = 0
+                await scheduler.pause()
+            else:
+                self.confirm_speed = None
+                self.confirm_deadline = None
+                await scheduler.stop()
+        except Exception as e:
+            # Sent again once the confirmation times out
+            self.logger.error("Failed to apply workout step: " + str(e))